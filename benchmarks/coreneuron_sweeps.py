@@ -0,0 +1,81 @@
+"""
+Activation sweeps of demo_CA1 channels: the default serial path,
+batched runs in NEURON and batched runs in CoreNEURON.
+
+CoreNEURON only compiles thread safe mechanisms with ion valences, so
+the channels are copied to a temporary directory first.
+
+    python benchmarks/coreneuron_sweeps.py [number of levels]
+"""
+import os
+import sys
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+# mechanisms are built for CoreNEURON only if this is set first
+os.environ["CHANNELUNIT_CORENEURON"] = "1"
+
+from channelunit import data_path
+from channelunit.base_classes import ModelPatch
+from channelunit.nmodl import mechanism_index
+from channelunit.nmodl import thread_safe
+
+channel_loc = os.path.join(data_path, "ion_channels")
+# channel, ion, conductance, external concentration (mM)
+CHANNELS = [("nap", "na", "gnabar", 110),
+            ("iM", "k", "gbar", 2.5),
+            ("cal12", "ca", "gbar", 1.5),
+            ("CaV21", "ca", "pbar", 1.5)]
+
+
+def coreneuron_mods(path):
+    """
+    Copy mod files of channel_loc CoreNEURON can compile to path
+    """
+    for mech in mechanism_index(channel_loc).values():
+        # NEURON knows the valences of na, k and ca
+        valences = all(name in ["na", "k", "ca"]
+                       or ion["valence"] is not None
+                       for name, ion in mech["ions"].items())
+        if thread_safe(mech) and valences:
+            shutil.copy2(os.path.join(channel_loc, mech["file"]), path)
+
+
+def timed(model, levels, backend, batched):
+    model.backend = backend
+    model.batched = batched
+    start = time.perf_counter()
+    out = model.get_activation_traces(levels, -90, 50, save_traces=False)
+    return time.perf_counter() - start, out
+
+
+def main(n_levels=50):
+    levels = list(np.linspace(-80, 40, n_levels))
+    path = tempfile.mkdtemp()
+    try:
+        coreneuron_mods(path)
+        for name, ion, gbar, conc in CHANNELS:
+            model = ModelPatch(path, [name], [ion],
+                               external_conc={ion: conc}, ljp=0, E_rev={},
+                               internal_conc={}, gbar_names={name: gbar},
+                               gbar_values={}, temp=22, recompile=True,
+                               cvode=False, Rm=20000, v_rest=-65, cm=1,
+                               directory="validation_results", sim_dt=0.01)
+            serial, _ = timed(model, levels, "neuron", False)
+            batched, reference = timed(model, levels, "neuron", True)
+            core, out = timed(model, levels, "coreneuron", True)
+            error = max(np.abs(reference[level] - out[level]).max()
+                        for level in levels)
+            print("%s, %d levels: serial %.2f s, batched %.2f s,"
+                  " CoreNEURON %.2f s, max difference to batched %.2g nA"
+                  % (name, n_levels, serial, batched, core, error))
+            model.close()
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,18 +1,26 @@
 # SPDX-License-Identifier: LGPL-2.1-or-later
-from .patch_models import ModelWholeCellPatch
-from .patch_models import ModelWholeCellPatchCa
-from .patch_models import ModelWholeCellPatchSingleChan
-from .patch_models import ModelWholeCellPatchCaSingleChan
-from .patch_models import ModelGiantExcisedPatch
-from .patch_models import ModelGiantExcisedPatchCa
-from .patch_models import ModelCellAttachedPatch
-from .patch_models import ModelCellAttachedPatchCa
-from .patch_models import ModelOocyte
-from .patch_models import ModelOocyteCa
-from .patch_models import ModelCaConcClamp
-
-
 import os
 loc = os.path.dirname(os.path.abspath(__file__))
 data_path = os.path.join(loc, "..", 'demo_CA1')
 mechanisms_path = os.path.join(loc, 'mechanisms')
+
+# models are imported on first use, they need NEURON and sciunit
+_models = ["ModelWholeCellPatch",
+           "ModelWholeCellPatchCa",
+           "ModelWholeCellPatchSingleChan",
+           "ModelWholeCellPatchCaSingleChan",
+           "ModelGiantExcisedPatch",
+           "ModelGiantExcisedPatchCa",
+           "ModelCellAttachedPatch",
+           "ModelCellAttachedPatchCa",
+           "ModelOocyte",
+           "ModelOocyteCa",
+           "ModelCaConcClamp"]
+__all__ = _models + ["data_path", "mechanisms_path"]
+
+
+def __getattr__(name):
+    if name in _models:
+        from . import patch_models
+        return getattr(patch_models, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -1,14 +1,24 @@
 import os
-from subprocess import run
+import gc
+import sys
+import weakref
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from fractions import Fraction
 
 import numpy as np
-from scipy.signal import bessel, lfilter
 
 import sciunit
 from neuron import h
-from neuron import rxd
-import neuron
+from channelunit import filters
 from channelunit.capabilities import NModlChannel
+from channelunit.mechanism_cache import compiled_library
+from channelunit.mechanism_cache import coreneuron
+from channelunit.mechanism_cache import load_mechanisms
+from channelunit.nmodl import mechanism_index
+from channelunit.nmodl import thread_safe
 
 
 loc = os.path.dirname(os.path.abspath(__file__))
@@ -17,17 +27,205 @@ mechanisms_path = os.path.join(loc, 'mechanisms')
 
 
 N = 4
-DT = 5e-5  #  Magee digitizes at 20kHz
+SAMPLING_RATE = 20  # kHz, Magee digitizes at 20kHz
+FILTER_CUTOFF = 5  # kHz, 8-pole Bessel
+DT = 1/SAMPLING_RATE  # ms
+# sampling (every 50 ns) and filter of channelunit before the rate
+# could be set, set_sampling(LEGACY_SAMPLING_RATE, LEGACY_FILTER_CUTOFF)
+# reproduces its outputs (see MembranePatch.legacy)
+LEGACY_SAMPLING_RATE = 20000
+LEGACY_FILTER_CUTOFF = 100
+NRN_DT = 0.025  # NEURON's default time step, used when cvode is True
 
 
 F = 96485.33212  # C mol^-1
 R = 8.314462618  # J mol^-1 K^-1
 
+# model state that is not copied to worker processes
+RUNTIME_ATTRIBUTES = ["_parked", "_in_session", "_recorders",
+                      "_recorder_dts", "_idle_recorders", "_out", "_buffers",
+                      "_description", "_init_args", "processes",
+                      "min_chunk", "_pool",
+                      "ca", "ca_decay", "decay_eq", "memb_shell", "geom",
+                      "_leak_templates", "_pn_templates", "_waveform"]
+
+
+def _plain(value):
+    if isinstance(value, (list, tuple)):
+        return all(_plain(val) for val in value)
+    if isinstance(value, dict):
+        return all(_plain(key) and _plain(val) for key, val in value.items())
+    return value is None or isinstance(value, (bool, int, float, str,
+                                               np.ndarray, np.generic))
+
+
+@functools.lru_cache()
+def _last_step(t_stop, sim_dt, chunk=4096):
+    """
+    Time of the last fixed step of a run till t_stop, the first one
+    within half a step of t_stop. NEURON adds up half steps, here
+    chunk steps at a time to keep the arrays short.
+    """
+    t = 0.0
+    while True:
+        half_steps = np.full(2*chunk + 1, sim_dt/2)
+        half_steps[0] = t
+        times = np.cumsum(half_steps)
+        steps = times[::2]
+        i = np.searchsorted(steps, t_stop - sim_dt/2)
+        if i < len(steps):
+            return steps[i]
+        t = times[-1]
+
+
+def _sample_times(step_times, record_dt):
+    """
+    Times Vector.record with record_dt samples at during a run
+    with step_times (NEURON adds up record_dt)
+    """
+    size = int(step_times[-1]/record_dt) + 2
+    times = np.zeros(size)
+    times[1:] = np.cumsum(np.full(size - 1, record_dt))
+    return times[times <= step_times[-1]]
+
+
+def _resample(step_times, values, dt, times):
+    """
+    Values recorded every time step at the sampling times. NEURON
+    takes a sample at the first step reaching half a step before
+    the sampling time.
+    """
+    index = np.searchsorted(step_times + 0.5*dt, times)
+    return values[..., np.minimum(index, values.shape[-1] - 1)]
+
+
+def _waveform(segments):
+    """
+    Times, values and indices of discontinuities (for Vector.play)
+    of a piecewise-linear command. segments: (duration, start, end),
+    a step if start == end, a ramp otherwise. Every segment after
+    the first one starts with a discontinuity at the time the previous
+    one ends.
+    """
+    durations = np.array([segment[0] for segment in segments], dtype=float)
+    ends = np.cumsum(durations)
+    times = np.repeat(np.concatenate([[0], ends[:-1]]), 2)
+    times[1::2] = ends
+    values = np.array([segment[1:] for segment in segments],
+                      dtype=float).ravel()
+    discontinuities = np.arange(1, 2*len(segments) - 1, 2)
+    return times, values, discontinuities
+
+
+def _by_row(value, rows):
+    """
+    List of rows values, value is one for every row or the same
+    for all of them
+    """
+    if np.ndim(value) == 0:
+        return [value]*rows
+    return list(value)
+
+
+def _stacked(currents):
+    """
+    Currents of a sweep as rows of one array. Protocols without P/N
+    pulses (leak = "cached") end earlier, their rows are padded
+    with the last sample: filtering is causal and their P/N pulses
+    are never read.
+    """
+    if isinstance(currents, np.ndarray):
+        return currents
+    size = max(len(current) for current in currents)
+    values = np.empty((len(currents), size))
+    for row, current in zip(values, currents):
+        row[:len(current)] = current
+        row[len(current):] = current[-1]
+    return values
+
+
+def _sweep_worker(snapshot, method, stimulation_levels, args):
+    """
+    Rebuild the model in a worker process and run the sweep. Workers
+    are reused by later sweeps, the model is closed afterwards.
+    """
+    model = snapshot["class"](*snapshot["args"], **snapshot["kwargs"])
+    try:
+        model._restore(snapshot)
+        return getattr(model, method)(stimulation_levels, *args)
+    finally:
+        model.close()
+
+
 class MembranePatch(sciunit.Model):
+    # all the models living in the NEURON instance
+    _models = weakref.WeakSet()
+
+    def __new__(cls, *args, **kwargs):
+        self = super(MembranePatch, cls).__new__(cls)
+        # worker processes rebuild the model from these
+        self._init_args = (args, kwargs)
+        return self
+
     def __init__(self, temp, Rm, cm,
                  v_rest, ljp, cvode, sim_dt):
         h.load_file("stdrun.hoc")
-        self.dt = DT
+        self._parked = False
+        self._in_session = 0
+        self._recorders = []
+        # sampling intervals of the recorders
+        self._recorder_dts = []
+        # released recorders, reused by _record
+        self._idle_recorders = []
+        # caller's array the traces of the running sweep are written
+        # to and the array of the traces of measured sweeps, see
+        # _trace_buffer
+        self._out = None
+        self._buffers = {}
+        self._description = None
+        # worker processes running sweeps, see _sweep. Workers start
+        # a new interpreter and load NEURON and the mechanisms, sweeps
+        # with less than min_chunk levels per worker run in this process
+        self.processes = 1
+        self.min_chunk = 4
+        # (processes, executor) of _worker_pool
+        self._pool = None
+        # simulate all the levels of a sweep at once, see _batched_run
+        self.batched = False
+        # simulate the levels of a sweep one after another in a single
+        # run with recovery ms at the holding potential in between,
+        # see _concatenated_run
+        self.concatenated = False
+        self.recovery = 100
+        # steady-state sweeps end as soon as the current at t_mes
+        # is recorded or, without t_mes, once the current has stayed
+        # within settle_tol of its peak for settle_time ms, see _watch
+        self.early_stop = False
+        self.settle_time = 5
+        self.settle_tol = 1e-3
+        self._measured = False
+        self._t_mes = None
+        self._watched = 0
+        # NEURON threads sharing the clones of a batched run
+        self.threads = 1
+        # "coreneuron" runs batched sweeps with CoreNEURON
+        self.backend = "neuron"
+        # "passive" subtracts the response of a passive copy of the
+        # patch instead of simulating P/N pulses, see _leak_template,
+        # "cached" simulates P/N pulses once, see _pn_key
+        self.leak = "pn"
+        self._leak_templates = {}
+        # "float32" keeps, transfers from worker processes and saves
+        # traces in single precision. NEURON integrates and currents
+        # are filtered and leak subtracted in double precision, every
+        # kept sample is the double one rounded once, within a relative
+        # error of 2**-24 (6e-8), see _windows
+        self.dtype = "float64"
+        # vectors played by set_waveform
+        self._waveform = None
+        self._pn_templates = {}
+        MembranePatch._models.add(self)
+        self.set_sampling()
         self.compile_and_add(mechanisms_path, True)
         self.junction = ljp
         self.patch = h.Section(name="patch")
@@ -49,23 +247,635 @@ class MembranePatch(sciunit.Model):
             self.sim_dt = sim_dt
             h.dt = self.sim_dt
             self.cvode = False
-        self.f_b, self.f_a = bessel(8, 100, btype='low',
-                                    analog=False, norm='mag', fs=1/DT)
-        
+
+    def set_sampling(self, rate=SAMPLING_RATE, cutoff=FILTER_CUTOFF,
+                     order=filters.ORDER):
+        """
+        Record currents at rate (kHz, a sample every self.dt ms)
+        and filter them with a Bessel filter with order poles and
+        cutoff (kHz), see filters
+        """
+        # checks the cutoff
+        filters.bessel_sos(order, cutoff, rate)
+        self.sampling_rate = rate
+        self.filter_cutoff = cutoff
+        self.filter_order = order
+        self.dt = 1/rate
+
+    @contextmanager
+    def sampling(self, rate=None, cutoff=None, order=None):
+        """
+        Sweeps run in the context record at rate and are filtered
+        with cutoff and order (see set_sampling), None keeps
+        the setting of the model
+        """
+        old = (self.sampling_rate, self.filter_cutoff, self.filter_order)
+        self.set_sampling(*[old_value if value is None else value
+                            for value, old_value
+                            in zip((rate, cutoff, order), old)])
+        try:
+            yield
+        finally:
+            self.set_sampling(*old)
+
+    @property
+    def legacy(self):
+        """
+        Sampling and filter of channelunit before the rate could be
+        set. Currents are filtered with (b, a) polynomials (lfilter)
+        and activation sweeps simulate the holding phase for every
+        level as channelunit did, outputs are the same to the bit.
+        Inactivation traces hold the whole run, the last sample and
+        the P/N pulses included, as they did.
+        """
+        return ((self.sampling_rate, self.filter_cutoff, self.filter_order)
+                == (LEGACY_SAMPLING_RATE, LEGACY_FILTER_CUTOFF,
+                    filters.ORDER))
+
+    def _filter(self, values):
+        """
+        values filtered along the last axis, see set_sampling
+        """
+        if self.legacy:
+            return filters.apply_ba((self.f_b, self.f_a), values)
+        return filters.apply(self.sos, values)
+
+    @property
+    def sos(self):
+        return filters.bessel_sos(self.filter_order, self.filter_cutoff,
+                                  self.sampling_rate)
+
+    @property
+    def f_b(self):
+        return filters.bessel_ba(self.filter_order, self.filter_cutoff,
+                                 self.sampling_rate)[0]
+
+    @property
+    def f_a(self):
+        return filters.bessel_ba(self.filter_order, self.filter_cutoff,
+                                 self.sampling_rate)[1]
+
     def compile_and_add(self, path, recompile):
-        working_dir = os.getcwd()
-        os.chdir(path)
-        if recompile:
-            p = run('nrnivmodl')
-        neuron.load_mechanisms(path)
-        os.chdir(working_dir)
+        load_mechanisms(path, recompile)
+
+    def _nrn_globals(self):
+        """
+        NEURON globals set by the model
+        """
+        if self.cvode:
+            return {"celsius": self.temperature, "dt": NRN_DT}
+        return {"celsius": self.temperature, "dt": self.sim_dt}
+
+    def _describe(self):
+        """
+        Names of range variables of density mechanisms and of ions
+        on the patch. Cached until channels are inserted or removed,
+        values are read from the segments (see _values).
+        """
+        if self._description is None:
+            psection = self.patch.psection()
+            self._description = {
+                key: {name: list(variables)
+                      for name, variables in psection[key].items()}
+                for key in ["density_mechs", "ions"]}
+        return self._description
+
+    def _values(self, name, mech_name=None):
+        """
+        Values of range variable name (of mechanism mech_name)
+        in every segment
+        """
+        values = []
+        for seg in self.patch:
+            obj = seg if mech_name is None else getattr(seg, mech_name)
+            value = getattr(obj, name)
+            if not isinstance(value, float):  # array variable
+                value = list(value)
+            values.append(value)
+        return values
+
+    def _set_values(self, name, values, mech_name=None):
+        for i, seg in enumerate(self.patch):
+            obj = seg if mech_name is None else getattr(seg, mech_name)
+            if isinstance(values[i], list):  # array variable
+                array = getattr(obj, name)
+                for j, value in enumerate(values[i]):
+                    array[j] = value
+            else:
+                setattr(obj, name, values[i])
+
+    def _patch_state(self):
+        """
+        Geometry and values of the range variables of the patch
+        """
+        state = {"mechanisms": {}, "ions": {}}
+        state["geometry"] = {name: getattr(self.patch, name)
+                             for name in ["nseg", "L", "diam", "Ra"]}
+        state["cm"] = self._values("cm")
+        description = self._describe()
+        for mech_name, names in description["density_mechs"].items():
+            state["mechanisms"][mech_name] = {
+                name: self._values(name, mech_name) for name in names}
+        for ion, names in description["ions"].items():
+            for name in ["e%s" % ion, "%si" % ion, "%so" % ion]:
+                if name in names:
+                    state["ions"][name] = self._values(name)
+        state["rs"] = self.vclamp.rs
+        return state
+
+    def _set_patch_state(self, state):
+        for name, value in state["geometry"].items():
+            setattr(self.patch, name, value)
+        self._set_values("cm", state["cm"])
+        for mech_name, values in state["mechanisms"].items():
+            for name, value in values.items():
+                self._set_values(name, value, mech_name)
+        for name, value in state["ions"].items():
+            self._set_values(name, value)
+        self.vclamp.rs = state["rs"]
+
+    def _snapshot(self):
+        """
+        Portable description of the model: constructor arguments,
+        attributes and the state of the patch
+        """
+        args, kwargs = self._init_args
+        snapshot = {"class": type(self), "args": args, "kwargs": kwargs,
+                    "attributes": {}, "patch": self._patch_state()}
+        for name, value in vars(self).items():
+            if name not in RUNTIME_ATTRIBUTES and _plain(value):
+                snapshot["attributes"][name] = value
+        return snapshot
+
+    def _restore(self, snapshot):
+        """
+        Set a freshly built model to the state of a _snapshot
+        """
+        self.__dict__.update(snapshot["attributes"])
+        self._set_patch_state(snapshot["patch"])
+
+    @contextmanager
+    def _using(self, patch, vclamp):
+        """
+        Make the model work on another section and clamp
+        """
+        old = self.patch, self.vclamp
+        self.patch, self.vclamp = patch, vclamp
+        try:
+            yield
+        finally:
+            self.patch, self.vclamp = old
+
+    def _clone(self):
+        """
+        New section with the mechanisms and values of the patch
+        and a clamp of its own
+        """
+        state = self._patch_state()
+        patch = h.Section(name="patch_clone")
+        for mech_name in state["mechanisms"]:
+            patch.insert(mech_name)
+        vclamp = h.SEClampOLS(patch(0.5))
+        with self._using(patch, vclamp):
+            self._set_patch_state(state)
+        return patch, vclamp
+
+    def _sweep(self, method, stimulation_levels, *args):
+        """
+        Run sweep method for stimulation_levels. With more than one
+        process the levels are split between worker processes
+        rebuilding the model from _snapshot and the results are merged
+        in the order of stimulation_levels. The workers are kept
+        for later sweeps till close().
+        """
+        processes = min(self.processes,
+                        len(stimulation_levels)//max(self.min_chunk, 1))
+        if processes < 2:
+            return getattr(self, method)(stimulation_levels, *args)
+        size = -(-len(stimulation_levels)//processes)
+        chunks = [list(stimulation_levels[i:i+size])
+                  for i in range(0, len(stimulation_levels), size)]
+        snapshot = self._snapshot()
+        results = list(self._worker_pool().map(_sweep_worker,
+                                               [snapshot]*len(chunks),
+                                               [method]*len(chunks), chunks,
+                                               [args]*len(chunks)))
+        time = results[0][0]
+        currents = {}
+        calcium = {}
+        for result in results:
+            currents.update(result[1])
+            calcium.update(result[2])
+        if method == "_two_pulse_sweep":
+            # (activation, inactivation) pairs, not rows of one array
+            return time, currents, calcium
+        size = np.shape(currents[stimulation_levels[0]])[-1]
+        values = self._trace_buffer(method, len(stimulation_levels), size)
+        if values is not None:
+            for row, level in zip(values, stimulation_levels):
+                row[:] = currents[level]
+            currents = self._windows(stimulation_levels, size, values)
+        return time, currents, calcium
+
+    def _worker_pool(self):
+        """
+        Pool of self.processes workers, made again if the number
+        of processes has changed
+        """
+        if self._pool is not None and self._pool[0] != self.processes:
+            self._close_pool()
+        if self._pool is None:
+            # fork would copy the NEURON instance of this process
+            context = multiprocessing.get_context("spawn")
+            self._pool = (self.processes,
+                          ProcessPoolExecutor(self.processes,
+                                              mp_context=context))
+        return self._pool[1]
+
+    def _close_pool(self):
+        if self._pool is not None:
+            self._pool[1].shutdown()
+            self._pool = None
+
+    def _windows(self, levels, size, values=None):
+        """
+        Traces of size samples by level, rows of values (of one array
+        of self.dtype allocated for the whole sweep if values is None)
+        """
+        if values is None:
+            values = np.empty((len(levels), size), self._trace_dtype())
+        return dict(zip(levels, values))
+
+    def _trace_dtype(self):
+        if self.dtype not in ["float64", "float32"]:
+            raise SystemExit('Unknown dtype %s, traces are "float64" or'
+                             ' "float32"' % self.dtype)
+        return self.dtype
+
+    def _trace_buffer(self, sweep, rows, size):
+        """
+        Array the traces of sweep (rows of size samples) are written
+        to: out of the caller (see _writing), an array of the model
+        reused by every sweep that is only measured (see _measuring)
+        or None for a new array
+        """
+        if self._out is not None:
+            if self._out.shape != (rows, size):
+                raise SystemExit("out has to be an array of shape (%d, %d)"
+                                 % (rows, size))
+            return self._out
+        if not self._measured:
+            return None
+        dtype = self._trace_dtype()
+        buffer = self._buffers.get(sweep, np.empty(0, dtype))
+        if buffer.size < rows*size or buffer.dtype != dtype:
+            buffer = np.empty(rows*size, dtype)
+            self._buffers[sweep] = buffer
+        return buffer[:rows*size].reshape(rows, size)
+
+    @contextmanager
+    def _writing(self, out):
+        """
+        Traces of the sweep run in the context are rows of out
+        """
+        self._out = out
+        try:
+            yield
+        finally:
+            self._out = None
+
+    def _park(self):
+        """
+        Take the model out of the sessions of other models. The
+        section, the clamp and the channels stay: the patch is a tree
+        of its own, integrating it does not change the results of
+        the other models.
+        """
+        self._parked = True
+
+    def _drop_shape(self):
+        """
+        Remove 3D points rxd gives to every section when a calcium
+        model is initialized, the patch stays a cylinder of L and
+        diam as it was built. The axial resistance of sections with
+        3D points differs in the last digit, results would depend
+        on the calcium models simulated before.
+        """
+        if self.patch is None or not self.patch.n3d():
+            return
+        diam = self._values("diam")
+        h.pt3dclear(sec=self.patch)
+        self._set_values("diam", diam)
+
+    def _unpark(self):
+        self._parked = False
+
+    @contextmanager
+    def session(self):
+        """
+        Simulations run in a session give the results of this model
+        alone. The other models are parked (see _park) and stay parked
+        till their own session: the rxd calcium of ModelPatchCa models
+        is removed (and their ca attribute is None) till then, their
+        sections, clamps and channels stay.
+        NEURON globals (celsius, dt, CVode tolerance, cao0_ca_ion)
+        are set for this model and restored at the exit.
+        """
+        if self._in_session:
+            self._in_session += 1
+            try:
+                yield self
+            finally:
+                self._in_session -= 1
+            return
+        nrn_globals = self._nrn_globals()
+        old_globals = {name: getattr(h, name) for name in nrn_globals}
+        old_atol = h.CVode().atol()
+        self._in_session = 1
+        try:
+            for model in list(MembranePatch._models):
+                if model is not self and not model._parked:
+                    model._park()
+            if self._parked:
+                self._unpark()
+            self._drop_shape()
+            for name, value in nrn_globals.items():
+                setattr(h, name, value)
+            if self.cvode:
+                h.CVode().atol(1e-7)
+            yield self
+        finally:
+            self._in_session = 0
+            self._release_recorders()
+            for name, value in old_globals.items():
+                setattr(h, name, value)
+            h.CVode().atol(old_atol)
+
+    def _record(self, ref, dt):
+        """
+        Vector recording ref every dt ms (every time step if dt is
+        None) till the end of the session. Vectors of the previous
+        sessions are reused, they keep their memory.
+        """
+        if self._idle_recorders:
+            vec = self._idle_recorders.pop()
+            vec.resize(0)
+        else:
+            vec = h.Vector()
+        # the clamp tells NEURON which thread records ref
+        if dt is None:
+            vec.record(self.vclamp, ref)
+        else:
+            vec.record(self.vclamp, ref, dt)
+        self._recorders.append(vec)
+        self._recorder_dts.append(dt)
+        return vec
+
+    def _release_recorders(self):
+        for vec in self._recorders:
+            vec.play_remove()
+        self._idle_recorders.extend(self._recorders)
+        self._recorders = []
+        self._recorder_dts = []
+
+    def close(self):
+        """
+        Delete the section, the clamp, rxd objects and recorders of
+        the model and stop its worker processes. The model cannot
+        be simulated afterwards.
+        """
+        self._close_pool()
+        if self.patch is None:
+            return
+        MembranePatch._models.discard(self)
+        self._release_recorders()
+        self._idle_recorders = []
+        self._buffers = {}
+        self._stop_waveform()
+        self.vclamp = None
+        h.delete_section(sec=self.patch)
+        self.patch = None
+        gc.collect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _checkpoint(self, v_init, t_branch):
+        """
+        Run from v_init till t_branch and save the state of the
+        simulation and what the recorders have got so far. Recording
+        restarts at the branch, t_branch is moved back to a time both
+        samples and time steps fall on (see _grid) for the samples to
+        stay on their grid. Without such a time the branch is at 0,
+        the whole protocol is simulated.
+        """
+        quantum = self._grid()
+        if quantum is None or self.legacy:
+            t_branch = 0
+        else:
+            t_branch = max(quantum*np.floor(t_branch/quantum + 1e-9), 0)
+        h.finitialize(v_init)
+        if self.cvode:
+            h.CVode().re_init()
+        else:
+            h.fcurrent()
+        h.frecord_init()
+        h.continuerun(t_branch)
+        recorded = []
+        for vec, dt in zip(self._recorders, self._recorder_dts):
+            # recording restarts with a sample at t, the last one
+            # is dropped if it was taken at t too
+            size = vec.size()
+            if dt is None or size - 1 == int(np.round(h.t/dt)):
+                size -= 1
+            recorded.append(vec.c(0, size - 1) if size > 0 else h.Vector())
+        return self._save_state(), recorded
+
+    def _time_step(self):
+        """
+        Step of the integrator, models with cvode are simulated
+        with NEURON's default fixed step (see _nrn_globals)
+        """
+        return NRN_DT if self.cvode else self.sim_dt
+
+    def _grid(self):
+        """
+        Shortest interval that is a multiple of both the time step and
+        the sampling interval, None if samples fall on half time steps:
+        which step NEURON records there depends on the last bit of t,
+        a run restarted at a branch picks other steps than a full run
+        """
+        step = Fraction(self._time_step()).limit_denominator(10**9)
+        ratio = Fraction(self.dt).limit_denominator(10**9)/step
+        if not ratio.denominator % 2:
+            return None
+        return float(step*ratio.numerator)
+
+    def _save_state(self):
+        state = h.SaveState()
+        state.save()
+        return state
+
+    def _restore_state(self, state):
+        state.restore(1)
+
+    def _continuerun(self, checkpoint, t_stop, watch=None):
+        """
+        Restore checkpoint and continue till t_stop (or till the run
+        is stopped by _watch called with watch). Recorders hold
+        the whole run, starting at t = 0.
+        """
+        state, recorded = checkpoint
+        self._restore_state(state)
+        if self.cvode:
+            h.CVode().re_init()
+        # clamp current is not a part of the saved state
+        h.fcurrent()
+        h.frecord_init()
+        if watch is not None:
+            t_stop = self._watch(*watch)
+        h.continuerun(t_stop)
+        for vec, old in zip(self._recorders, recorded):
+            if old.size():
+                vec.insrt(0, old)
+
+    @contextmanager
+    def _measuring(self, t_mes):
+        """
+        Sweeps run in the context are only read at t_mes (at the peak
+        if t_mes is None) and can end early, see _watch
+        """
+        self._measured = True
+        self._t_mes = t_mes
+        try:
+            yield
+        finally:
+            self._measured = False
+            self._t_mes = None
+
+    def _run_size(self, t_stop):
+        """
+        Number of samples recorded every self.dt ms in a run till
+        t_stop. NEURON adds up the half time steps as well as the
+        sampling intervals, fixed steps end within half a step of t_stop.
+        """
+        if not self.cvode:
+            t_stop = _last_step(t_stop, self.sim_dt)
+        return len(_sample_times([t_stop], self.dt))
+
+    def _watch(self, t_step, dur, t_stop, t_mes, step, leak_subtraction,
+               time, current):
+        """
+        End of a run of a steady-state sweep with early_stop. With t_mes
+        (ms from the beginning of the run) the run ends right after
+        t_mes. Without it the current recorded in current since
+        the step at t_step is checked with CVode events and the run
+        is stopped once the current has stayed within settle_tol of
+        its peak for settle_time ms. The electrode current is checked
+        without the passive leak (step mV, dur ms long). P/N pulses
+        follow the step, with other leak modes the run goes on till
+        t_stop.
+        """
+        if not (self.early_stop and self._measured):
+            return t_stop
+        if leak_subtraction and self._leak_mode() != "passive":
+            return t_stop
+        if t_mes is not None:
+            return min(t_stop, t_mes + self._time_step())
+        leak = None
+        if leak_subtraction:
+            leak = step*self._leak_template(t_step, dur, self.dt)
+        size = int(np.round(self.settle_time/self.dt))
+        interval = self.settle_time/5
+        self._watched += 1
+        watched = self._watched
+
+        def check():
+            # events of earlier runs may be left in the queue
+            if watched != self._watched:
+                return
+            times = time.as_numpy()
+            since = len(times) - np.searchsorted(times, t_step)
+            if since >= size:
+                values = current.as_numpy()[-since:]
+                if leak is not None:
+                    end = int(np.round(times[-1]/self.dt)) + 1
+                    values = values - leak[end - since: end]
+                last = values[-size:]
+                if last.max() - last.min() <= (self.settle_tol
+                                               *np.abs(values).max()):
+                    h.stoprun = 1
+                    return
+            if h.t + interval < t_stop:
+                h.CVode().event(h.t + interval, check)
+
+        h.CVode().event(t_step + self.settle_time, check)
+        return t_stop
+
+    def _padded(self, values, t_stop, time=False):
+        """
+        Values of a run stopped early (see _watch) extended to
+        the size of a run till t_stop with the last value (times
+        with a sample every self.dt ms)
+        """
+        missing = self._run_size(t_stop) - len(values)
+        if not self.early_stop or missing <= 0:
+            return values
+        if time:
+            tail = values[-1] + self.dt*np.arange(1, missing + 1)
+        else:
+            tail = np.full(missing, values[-1])
+        return np.concatenate([values, tail])
+
+    def set_waveform(self, segments):
+        """
+        Clamp the patch with a piecewise-linear command of any number
+        of segments: (duration, start, end) with voltages in mV,
+        steps have start == end. The command is played into amp1
+        of the clamp with the transitions declared as discontinuities,
+        CVode steps exactly at them. Commands with the same durations
+        reuse the played vectors, only the amplitudes are updated.
+        Returns the duration of the command.
+        """
+        times, values, discontinuities = _waveform(segments)
+        values -= self.junction
+        if (self._waveform is not None
+                and np.array_equal(self._waveform[0].as_numpy(), times)):
+            tvec, waveform, dvec = self._waveform
+            waveform.as_numpy()[:] = values
+        else:
+            self._stop_waveform()
+            tvec = h.Vector(times)
+            waveform = h.Vector(values)
+            dvec = h.Vector(discontinuities)
+            waveform.play(self.vclamp._ref_amp1, tvec, 1, dvec)
+            self._waveform = (tvec, waveform, dvec)
+        self.vclamp.dur1 = times[-1]
+        self.vclamp.amp1 = values[0]
+        for i in range(2, 13):
+            setattr(self.vclamp, "dur%d" % i, 0)
+        return times[-1]
+
+    def _stop_waveform(self):
+        """
+        Stop playing the command of set_waveform
+        """
+        if self._waveform is not None:
+            self._waveform[1].play_remove()
+            self._waveform = None
 
     def set_vclamp(self, dur1, v1, dur2, v2, leak_subtraction):
+        self._stop_waveform()
         self.vclamp.dur1 = dur1
         self.vclamp.amp1 = v1 - self.junction
         self.vclamp.dur2 = dur2
         self.vclamp.amp2 = v2 - self.junction
-        if not leak_subtraction:
+        if (not leak_subtraction or self._leak_mode() == "passive"
+                or self._pn_key(v1, v2 - v1, dur1, dur2,
+                                self.dt) in self._pn_templates):
             self.vclamp.dur3 = 0
             self.vclamp.dur4 = 0
             self.vclamp.dur5 = 0
@@ -76,6 +886,9 @@ class MembranePatch(sciunit.Model):
             self.vclamp.dur10 = 0
             self.vclamp.dur11 = 0
             self.vclamp.dur12 = 0
+            if leak_subtraction:
+                # the last sample of the pulse is needed
+                return dur1 + dur2 + self.dt
             return dur1+dur2
 
         pulse_amp = self.vclamp.amp2 - self.vclamp.amp1
@@ -108,17 +921,97 @@ class MembranePatch(sciunit.Model):
         self.vclamp.dur12 = dur2
         return dur1 + 11*dur2
 
-    def run(self, t_stop, dt=DT):
-        current = h.Vector()
-        current.record(self.vclamp._ref_i, dt)
-        h.finitialize(self.patch.e_pas)
-        if self.cvode:
-            h.CVode().re_init()
-        else:
-            h.fcurrent()
-        h.frecord_init()
-        h.continuerun(t_stop)
-        return current.as_numpy()
+    def _passive_key(self):
+        """
+        What the leak and capacitive currents of the patch depend on
+        """
+        return (self.cvode, self._nrn_globals()["dt"], self.vclamp.rs,
+                tuple(getattr(self.patch, name)
+                      for name in ["nseg", "L", "diam", "Ra"]),
+                tuple(self._values("cm")), tuple(self._values("g_pas")))
+
+    def _leak_mode(self):
+        if self.leak not in ["pn", "passive", "cached"]:
+            raise SystemExit('Unknown leak %s, leak is subtracted with "pn",'
+                             ' "passive" or "cached"' % self.leak)
+        return self.leak
+
+    def _pn_key(self, v_hold, step, dur1, dur2, dt):
+        """
+        Key of the P/N pulse of a step from v_hold in
+        self._pn_templates. With leak = "cached" the pulse is taken
+        from the first sweep with the key, later sweeps leave the P/N
+        segments out. The channels are supposed to be closed at the
+        P/N levels (as for any P/N subtraction), so only the inserted
+        mechanisms and the passive properties are a part of the key,
+        not the channel parameters. None for other leak modes.
+        """
+        if self._leak_mode() != "cached":
+            return None
+        # the pulses are filtered
+        return ((v_hold, step, dur1, dur2, dt, self.filter_cutoff,
+                 self.filter_order, self.v_low, self.junction,
+                 tuple(self._describe()["density_mechs"]))
+                + self._passive_key())
+
+    def _leak_template(self, dur1, dur2, dt):
+        """
+        Electrode current of a passive copy of the patch (geometry, cm,
+        pas and clamp resistance, no channels) stepped by 1 mV after
+        dur1 ms, recorded every dt ms. Leak and capacitive currents
+        are linear in the step, extract_current scales the template
+        instead of subtracting P/N pulses. Simulated once for every
+        passive state of the patch.
+        """
+        key = (dur1, dur2, dt) + self._passive_key()
+        if key in self._leak_templates:
+            return self._leak_templates[key]
+        patch = h.Section(name="patch_passive")
+        for name in ["nseg", "L", "diam", "Ra"]:
+            setattr(patch, name, getattr(self.patch, name))
+        patch.insert("pas")
+        for seg, old in zip(patch, self.patch):
+            seg.cm = old.cm
+            seg.g_pas = old.g_pas
+            seg.e_pas = old.e_pas
+        vclamp = h.SEClampOLS(patch(0.5))
+        vclamp.rs = self.vclamp.rs
+        v_rest = self.patch.e_pas
+        try:
+            with self.session(), self._using(patch, vclamp):
+                t_stop = self.set_vclamp(dur1, v_rest + self.junction, dur2,
+                                         v_rest + self.junction + 1, False)
+                current = self._record(vclamp._ref_i, dt)
+                h.finitialize(v_rest)
+                if self.cvode:
+                    h.CVode().re_init()
+                else:
+                    h.fcurrent()
+                h.frecord_init()
+                h.continuerun(t_stop + dt)
+                template = current.as_numpy().copy()
+                # the last recorder, the other ones are kept
+                current.play_remove()
+                self._idle_recorders.append(self._recorders.pop())
+                self._recorder_dts.pop()
+        finally:
+            h.delete_section(sec=patch)
+        self._leak_templates[key] = template
+        return template
+
+    def run(self, t_stop, dt=None):
+        if dt is None:
+            dt = self.dt
+        with self.session():
+            current = self._record(self.vclamp._ref_i, dt)
+            h.finitialize(self.patch.e_pas)
+            if self.cvode:
+                h.CVode().re_init()
+            else:
+                h.fcurrent()
+            h.frecord_init()
+            h.continuerun(t_stop)
+            return current.as_numpy().copy()
 
     @classmethod
     def curr_stim_response(self, I, dur1, dur2, dt,
@@ -128,22 +1021,26 @@ class MembranePatch(sciunit.Model):
         current = I.copy()
         if leak_subtraction:
             beg = int(np.round(abs(dur1 - dur2)/dt))
-            current[beg_stim: end_stim] -= I[beg: beg_stim]
+            current[..., beg_stim: end_stim] -= I[..., beg: beg_stim]
         return current
 
     @classmethod
     def curr_leak_amp(self, I, dur1, dur2, dt):
-        t_start =  dur1 + 2*dur2 
-        length = int(dur2/dt)
-        pulse = np.zeros((length,))
-        for i in range(N):
-            bas_start = int(np.round(t_start/dt))
-            pulse_start = int(np.round((t_start+dur2)/dt))
-            basal = I[bas_start:pulse_start].copy()
-            pulse_end = int(np.round((t_start+2*dur2)/dt))
-            pulse += (I[pulse_start:pulse_end].copy() - basal)
-            t_start += 2*dur2
-        return pulse.copy()
+        """
+        Sum of the N P/N pulses minus their baselines, along the last
+        axis of I
+        """
+        from numpy.lib.stride_tricks import sliding_window_view
+        t_starts = [dur1 + 2*dur2]
+        for i in range(1, N):
+            t_starts.append(t_starts[-1] + 2*dur2)
+        bas_starts = [int(np.round(t_start/dt)) for t_start in t_starts]
+        pulse_starts = [int(np.round((t_start+dur2)/dt))
+                        for t_start in t_starts]
+        # every window of dur2 ms, a view of I
+        windows = sliding_window_view(I, int(np.round(dur2/dt)), axis=-1)
+        return (windows[..., pulse_starts, :]
+                - windows[..., bas_starts, :]).sum(axis=-2)
 
     @property
     def cm(self):
@@ -167,6 +1064,8 @@ class ModelPatch(MembranePatch, NModlChannel):
     _nai = 10  # mM
     _ki = 140  # mM
     _cai = 50e-6  # mM
+    # rxd calcium shell, see ModelPatchCa (ca is None while parked)
+    _calcium = False
     def __init__(self, path_to_mods: str, channel_names: list, ion_names: list,
                  external_conc: dict, internal_conc: dict, E_rev: dict,
                  gbar_names: dict, gbar_values: dict,
@@ -247,24 +1146,36 @@ class ModelPatch(MembranePatch, NModlChannel):
         self.ca = None
         
     def add_channel(self, channel_name, gbar_name, gbar_value):
+        # check the mod file before touching NEURON
+        mech = mechanism_index(self.mod_path).get(channel_name)
+        if mech is not None and gbar_name not in mech["range"]:
+            raise SystemExit('Unable to proceed, unknown %s conductance (gbar)'
+                             ' %s, %s has %s'
+                             % (channel_name, gbar_name, mech["file"],
+                                ", ".join(mech["conductances"])))
         self.channel_names.append(channel_name)
         self.patch.insert(channel_name)
+        self._description = None
 
-        chan = self.patch.psection()["density_mechs"][channel_name]
+        chan = self._describe()["density_mechs"][channel_name]
         self.channels.append(chan)
-        if gbar_name not in chan.keys():
+        if gbar_name not in chan:
             raise SystemExit('Unable to proceed, unknown %s conductance (gbar)'
                              % channel_name)
         self.gbar_names[channel_name] = gbar_name
-        if chan[gbar_name][0] == 0:
+        if self._values(gbar_name, channel_name)[0] == 0:
             for seg in self.patch:
                 from_mech = getattr(seg, channel_name)
                 setattr(from_mech, gbar_name, gbar_value)
 
 
+    def _ion_value(self, ion_name, name):
+        if ion_name not in self._describe()["ions"]:
+            raise KeyError(ion_name)
+        return self._values(name)[0]
+
     def get_gbar(self, channel_name):
-        mech = self.patch.psection()["density_mechs"][channel_name]
-        values = mech[self.gbar_names[channel_name]]
+        values = self._values(self.gbar_names[channel_name], channel_name)
         if len(values) == 1:
             return values[0]
         elif len(set(values)) == 1:
@@ -305,14 +1216,12 @@ class ModelPatch(MembranePatch, NModlChannel):
 
         if external is None:
             if E_rev is None:
-                name = "e%s" % ion_name
-                return self.patch.psection()["ions"][ion_name][name][0]
+                return self._ion_value(ion_name, "e%s" % ion_name)
             else:
                 return E_rev
         elif not isinstance(external, int) and not isinstance(external, float):
             if E_rev is None:
-                name = "e%s" % ion_name
-                return self.patch.psection()["ions"][ion_name][name][0]
+                return self._ion_value(ion_name, "e%s" % ion_name)
             else:
                 return E_rev
         assert internal > 0
@@ -321,6 +1230,31 @@ class ModelPatch(MembranePatch, NModlChannel):
         E_rev = 1e3*R*(273.15+self.temperature)/(valence*F)*conc_fact
         return E_rev
 
+    def _restore(self, snapshot):
+        # channels added after the model was built
+        attributes = snapshot["attributes"]
+        for channel_name in attributes["channel_names"]:
+            if channel_name not in self.channel_names:
+                self.add_channel(channel_name,
+                                 attributes["gbar_names"][channel_name], 0)
+        super(ModelPatch, self)._restore(snapshot)
+
+    def _save_csv(self, fname, time, values):
+        """
+        Save traces by level to base_directory/data/fname.csv
+        """
+        path = os.path.join(self.base_directory, "data")
+        if not os.path.exists(path):
+            os.makedirs(path)
+        header = "time"
+        for level in values:
+            header += ";%4.2f" % level
+        path_to_save = os.path.join(path, "%s.csv" % fname)
+        # 9 significant digits tell single precision numbers apart
+        fmt = "%.8e" if self.dtype == "float32" else "%.18e"
+        np.savetxt(path_to_save, np.array([time] + list(values.values())),
+                   fmt=fmt, delimiter=";", header=header, comments="")
+
     def generate_fname(self, suffix, stim_beg, stim_end, chord_conductance,
                        electrode_current, ca_conc):
         fname = suffix
@@ -352,32 +1286,226 @@ class ModelPatch(MembranePatch, NModlChannel):
             fname = "%s_Ca_conc" % fname
         return fname
 
-    def _record_current(self, electrode_current, chord_conductance):
-        current = h.Vector()
-        if electrode_current:
-            current.record(self.vclamp._ref_i, self.dt)
-        else:
+    def _record_current(self, electrode_current, chord_conductance, dt):
+        ref = self.vclamp._ref_i
+        if not electrode_current:
             if len(self.ion_names) > 1:
-                current.record(self.vclamp._ref_i, self.dt)
                 chord_conductance = False
-            else:
-                if self.ion_names[0] == "na":
-                    current.record(self.patch(0.5)._ref_ina, self.dt)
-                elif self.ion_names[0] == "k":
-                    current.record(self.patch(0.5)._ref_ik, self.dt)
-                elif self.ion_names[0] == "ca":
-                    current.record(self.patch(0.5)._ref_ica, self.dt)
-                elif self.ion_names[0] == "ba":
-                    current.record(self.patch(0.5)._ref_ica, self.dt)
+            elif self.ion_names[0] == "na":
+                ref = self.patch(0.5)._ref_ina
+            elif self.ion_names[0] == "k":
+                ref = self.patch(0.5)._ref_ik
+            elif self.ion_names[0] in ["ca", "ba"]:
+                ref = self.patch(0.5)._ref_ica
+        return self._record(ref, dt), chord_conductance
+
+    def _check_backend(self):
+        """
+        Check that a batched run can use self.threads and self.backend
+        """
+        if self.backend not in ["neuron", "coreneuron"]:
+            raise SystemExit('Unknown backend %s, use neuron or coreneuron'
+                             % self.backend)
+        if self.threads > 1:
+            what = "in %d threads" % self.threads
+            index = mechanism_index(mechanisms_path)
+            index.update(mechanism_index(self.mod_path))
+            density_mechs = self._describe()["density_mechs"]
+            unsafe = [index[name]["file"] for name in density_mechs
+                      if name in index and not thread_safe(index[name])]
+            if unsafe:
+                raise SystemExit('Unable to run %s, %s not thread safe.'
+                                 ' Declare THREADSAFE in the NEURON block'
+                                 ' or run with threads = 1'
+                                 % (what, ", ".join(unsafe)))
+        elif self.backend == "coreneuron":
+            what = "with CoreNEURON"
+        else:
+            return
+        if self.backend == "coreneuron":
+            if not coreneuron():
+                raise SystemExit('Unable to run with CoreNEURON, set'
+                                 ' CHANNELUNIT_CORENEURON=1 before making'
+                                 ' the first model')
+            if self.cvode:
+                raise SystemExit('Unable to run with CoreNEURON, it only'
+                                 ' runs fixed step, make the model with'
+                                 ' cvode=False')
+            build_dir = load_mechanisms(self.mod_path, False)
+            library = compiled_library(build_dir, "corenrnmech")
+            if library != os.environ.get("CORENEURONLIB"):
+                raise SystemExit('Unable to run with CoreNEURON, it loads'
+                                 ' %s without the mechanisms from %s'
+                                 % (os.environ.get("CORENEURONLIB"),
+                                    self.mod_path))
+        rxd = sys.modules.get("neuron.rxd.rxd")
+        if rxd is not None and rxd._has_nbs_registered:
+            raise SystemExit('Unable to run %s, rxd (used by calcium models)'
+                             ' has been set up in this process' % what)
+
+    def _psolve(self, t_stop):
+        """
+        Initialize with the voltages of the segments and run
+        till t_stop with CoreNEURON
+        """
+        from neuron import coreneuron as coreneuron_settings
+
+        pc = h.ParallelContext()
+        cache_efficient = h.CVode().cache_efficient()
+        h.CVode().cache_efficient(1)
+        coreneuron_settings.enable = True
+        coreneuron_settings.verbose = 0
+        try:
+            h.finitialize()
+            pc.set_maxstep(10)
+            pc.psolve(t_stop)
+        finally:
+            coreneuron_settings.enable = False
+            h.CVode().cache_efficient(cache_efficient)
+
+    def _batched_run(self, clamps, v_inits, electrode_current,
+                     chord_conductance, protocol="set_vclamp"):
+        """
+        Simulate a clone of the patch for every element of clamps,
+        arguments of protocol (set_vclamp or set_two_pulse_vclamp)
+        without leak_subtraction, starting from v_inits in a single
+        run. Returns time, recorded currents (rows of an array) and
+        chord_conductance (see _record_current). With self.concatenated
+        the patch runs the protocols one after another, see
+        _concatenated_run.
+        """
+        if self.concatenated:
+            return self._concatenated_run(clamps, v_inits,
+                                          electrode_current,
+                                          chord_conductance, protocol)
+        leak_subtraction = bool(electrode_current)
+        self._check_backend()
+        pc = h.ParallelContext()
+        nthread = pc.nthread()
+        # NEURON samples every dt ms half a step late in the other
+        # threads and CoreNEURON only records every step, the currents
+        # are resampled
+        record_dt = self.dt
+        if self.threads > 1 or self.backend == "coreneuron":
+            record_dt = None
+        with self.session():
+            time = self._record(h._ref_t, record_dt)
+            patches = [(self.patch, self.vclamp)]
+            patches += [self._clone() for i in range(1, len(clamps))]
+            try:
+                pc.nthread(self.threads)
+                currents = []
+                t_stop = 0
+                for (patch, vclamp), args in zip(patches, clamps):
+                    with self._using(patch, vclamp):
+                        t_stop = max(t_stop, getattr(self, protocol)(
+                            *args, leak_subtraction))
+                        current, chord = self._record_current(
+                            electrode_current, chord_conductance, record_dt)
+                    currents.append(current)
+                for (patch, vclamp), v_init in zip(patches, v_inits):
+                    for seg in patch:
+                        seg.v = v_init
+                if self.backend == "coreneuron":
+                    self._psolve(t_stop)
+                else:
+                    # keeps the voltages set above
+                    h.finitialize()
+                    if self.cvode:
+                        h.CVode().re_init()
+                    else:
+                        h.fcurrent()
+                    h.frecord_init()
+                    h.continuerun(t_stop)
+                time = time.as_numpy().copy()
+                currents = np.array([current.as_numpy()
+                                     for current in currents])
+                if record_dt is None:
+                    steps = time
+                    time = _sample_times(steps, self.dt)
+                    currents = _resample(steps, currents, h.dt, time)
+                return time, currents, chord
+            finally:
+                self._release_recorders()
+                for patch, vclamp in patches[1:]:
+                    h.delete_section(sec=patch)
+                pc.nthread(nthread)
+
+    def _concatenated_run(self, clamps, v_inits, electrode_current,
+                          chord_conductance, protocol="set_vclamp"):
+        """
+        Simulate the patch clamped with the protocols of clamps
+        (see _batched_run) one after another in a single run, as a rig
+        chains sweeps. Before every protocol but the first one the
+        patch recovers for self.recovery ms at the protocol's v_init
+        instead of being initialized. The protocols are chained into
+        one command, see set_waveform. Returns the time of the first
+        protocol, currents recorded during every protocol and
+        chord_conductance (see _record_current).
+        """
+        leak_subtraction = bool(electrode_current)
+        # protocols start at a time step of the simulation and
+        # at a sample
+        quantum = self._grid() or self._time_step()
+        segments = []
+        starts, stops = [], []
+        t = 0
+        for args, v_init in zip(clamps, v_inits):
+            stop = getattr(self, protocol)(*args, leak_subtraction)
+            if starts:
+                start = quantum*np.ceil((t + self.recovery)/quantum - 1e-9)
+                segments.append((start - t, v_init, v_init))
+                t = start
+            starts.append(t)
+            stops.append(stop)
+            for i in range(1, 13):
+                dur = getattr(self.vclamp, "dur%d" % i)
+                if dur:
+                    amp = getattr(self.vclamp, "amp%d" % i) + self.junction
+                    segments.append((dur, amp, amp))
+                    t += dur
+            # the last level is held till the end of the protocol
+            if t < starts[-1] + stop:
+                dur, amp, amp = segments[-1]
+                segments[-1] = (dur + starts[-1] + stop - t, amp, amp)
+                t = starts[-1] + stop
+        self.set_waveform(segments)
+        self.vclamp.dur1 = t + quantum
+        with self.session():
+            current, chord_conductance = self._record_current(
+                electrode_current, chord_conductance, self.dt)
+            time = self._record(h._ref_t, self.dt)
+            try:
+                h.finitialize(v_inits[0])
+                if self.cvode:
+                    h.CVode().re_init()
                 else:
-                    current.record(self.vclamp._ref_i, self.dt)
-        return current, chord_conductance
+                    h.fcurrent()
+                h.frecord_init()
+                currents = []
+                for start, stop in zip(starts, stops):
+                    h.continuerun(start)
+                    # only the samples of the protocol are kept
+                    first = np.searchsorted(time.as_numpy(),
+                                            start - self.dt/2)
+                    if first:
+                        time.remove(0, first - 1)
+                        current.remove(0, first - 1)
+                    h.continuerun(start + stop + quantum)
+                    # as many samples as a run of the protocol alone
+                    size = self._run_size(stop)
+                    currents.append(current.as_numpy()[:size].copy())
+                    if start == 0:
+                        protocol_time = time.as_numpy()[:size].copy()
+            finally:
+                self._stop_waveform()
+        return protocol_time, currents, chord_conductance
 
     def get_activation_traces(self, stimulation_levels: list,
                               v_hold: float, t_stop:float,
                               chord_conductance=False,
                               electrode_current=True,
-                              save_traces=True, save_ca=False):
+                              save_traces=True, save_ca=False, out=None):
         """
         Function for running step experiments to determine 
         current/chord conductance traces
@@ -403,103 +1531,117 @@ class ModelPatch(MembranePatch, NModlChannel):
           minus the ion's reversal potential.
         duration: float
           duration of the simulation
+        out: array
+          (len(stimulation_levels), samples of t_stop) array the traces
+          are written to, they are returned as its rows
         """
-        out_I = []
-        delay = t_stop
-        shift = 0 #(self.patch.cm/self.patch.g_pas)*1e-3
-        if not electrode_current:
-            leak_subtraction = False
-        else:
-            leak_subtraction = True
+        if save_ca and not self._calcium:
+            save_ca = False
+        with self._writing(out):
+            time, current_vals, calcium_vals = self._sweep(
+                "_activation_sweep", stimulation_levels, v_hold, t_stop,
+                chord_conductance, electrode_current, save_ca)
         if save_traces:
             fname = self.generate_fname("Activation_traces",
                                         min(stimulation_levels),
                                         max(stimulation_levels),
                                         chord_conductance,
                                         electrode_current, False)
-            output = []
-            header = "time"
-        if save_ca and self.ca is None:
-            save_ca = False
+            self._save_csv(fname, time, current_vals)
         if save_ca:
             ca_fname = self.generate_fname("Activation_traces",
-                                        min(stimulation_levels),
-                                        max(stimulation_levels),
-                                        chord_conductance,
-                                        electrode_current, True)
-            calcium_vals = []
-            calcium = h.Vector()
-            cal_ref = self.ca[self.memb_shell].nodes[0]._ref_concentration
-            calcium.record(cal_ref,
-                           self.dt)
+                                           min(stimulation_levels),
+                                           max(stimulation_levels),
+                                           chord_conductance,
+                                           electrode_current, True)
+            self._save_csv(ca_fname, time, calcium_vals)
+        return current_vals
+
+    def _activation_sweep(self, stimulation_levels, v_hold, t_stop,
+                          chord_conductance, electrode_current, save_ca):
+        """
+        Activation steps for stimulation_levels. Returns the time
+        of the steps and currents and calcium (if save_ca) by level.
+        """
+        delay = t_stop
+        shift = 0 #(self.patch.cm/self.patch.g_pas)*1e-3
+        if not electrode_current:
+            leak_subtraction = False
         else:
-            ca_fname = ""
-        h.celsius = self.temperature
-        current_vals = {}
-        current,\
-            chord_conductance = self._record_current(electrode_current,
-                                                     chord_conductance)
-        time = h.Vector()
-        time.record(h._ref_t, self.dt)
-        voltage = h.Vector()
-        voltage.record(self.patch(0.5)._ref_v, self.dt)
-        stim_start = int(delay/self.dt)
-        out_v = []
+            leak_subtraction = True
         beg = int(np.round((shift+delay)/self.dt))
         end = int(np.round((delay+t_stop)/self.dt))
-        for i, level in enumerate(stimulation_levels):
-            stim_stop = self.set_vclamp(delay, v_hold, t_stop, level,
-                                        leak_subtraction)
-            h.finitialize(v_hold)
-            if self.cvode:
-                h.CVode().re_init()
-            else:
-                h.fcurrent()
-            h.frecord_init()
-
-            h.continuerun(stim_stop)
-
-            I = current.as_numpy()
-            if not i:
-                out_I.append(time.as_numpy())
-            out_I.append(current.as_numpy().copy())
-            out = self.extract_current(I, chord_conductance,
-                                       leak_subtraction,
-                                       delay+shift,t_stop, self.dt,
-                                       level)
-
+        buffer = self._trace_buffer("_activation_sweep",
+                                    len(stimulation_levels), end - beg)
+        if leak_subtraction and self._leak_mode() == "passive":
+            # simulated before the checkpoint, a new section would
+            # invalidate it
+            self._leak_template(delay+shift, t_stop, self.dt)
+        if (self.batched or self.concatenated) and not self._calcium:
+            clamps = [(delay, v_hold, t_stop, level)
+                      for level in stimulation_levels]
+            time, currents,\
+                chord_conductance = self._batched_run(
+                    clamps, [v_hold]*len(clamps), electrode_current,
+                    chord_conductance)
+            current_vals = self._windows(stimulation_levels, end - beg,
+                                         buffer)
+            out = self.extract_currents(
+                _stacked(currents), chord_conductance, leak_subtraction,
+                delay+shift, t_stop, self.dt, stimulation_levels,
+                step=[level - v_hold for level in stimulation_levels],
+                v_hold=v_hold, t_read=delay+t_stop)
+            for level, row in zip(stimulation_levels, out):
+                current_vals[level][:] = row[beg: end]
+            return time[beg: end].copy(), current_vals, {}
+        with self.session():
             if save_ca:
-                if not i:
-                    save_time = time.as_numpy().copy()
-                    calcium_vals.append(save_time[beg: end])
-  
-                calcium_vals.append(calcium.as_numpy().copy()[beg: end])
-            if save_traces:
-                if not i:
-                    save_time = time.as_numpy().copy()
-                    output.append(save_time[beg: end].copy())
-                output.append(out[beg: end].copy())
-                
-                header += ";%4.2f" % level
-            current_vals[level] = out[beg: end].copy()
-
-        if save_traces:
-            path = os.path.join(self.base_directory, "data")
-            if not os.path.exists(path):
-                os.makedirs(path)
-            path_to_save = os.path.join(path, "%s.csv" % fname)
-            np.savetxt(path_to_save, np.array(output), delimiter=";",
-                       header=header, comments="")
-       
-        if save_ca:
-            path = os.path.join(self.base_directory, "data")
-            if not os.path.exists(path):
-                os.makedirs(path)
-            path_to_save = os.path.join(path, "%s.csv" % ca_fname)
-            np.savetxt(path_to_save, np.array(calcium_vals), delimiter=";",
-                       header=header, comments="")
-      
-        return current_vals
+                cal_ref = self.ca[self.memb_shell].nodes[0]._ref_concentration
+                calcium = self._record(cal_ref, self.dt)
+                calcium_vals = self._windows(stimulation_levels, end - beg)
+            else:
+                calcium_vals = {}
+            current_vals = self._windows(stimulation_levels, end - beg,
+                                         buffer)
+            current,\
+                chord_conductance = self._record_current(electrode_current,
+                                                         chord_conductance,
+                                                         self.dt)
+            time = self._record(h._ref_t, self.dt)
+            # the holding phase is the same for all the levels, the clamp
+            # is initialized with the longest protocol (levels with
+            # a cached P/N pulse stop after the test pulse)
+            longest = max(stimulation_levels,
+                          key=lambda level: self.set_vclamp(
+                              delay, v_hold, t_stop, level, leak_subtraction))
+            self.set_vclamp(delay, v_hold, t_stop, longest, leak_subtraction)
+            holding = self._checkpoint(v_hold, max(delay - h.dt, 0))
+            if self._t_mes is not None:
+                t_mes = delay + self._t_mes
+            else:
+                t_mes = None
+            for level in stimulation_levels:
+                stim_stop = self.set_vclamp(delay, v_hold, t_stop, level,
+                                            leak_subtraction)
+                self._continuerun(holding, stim_stop,
+                                  (delay, t_stop, stim_stop, t_mes,
+                                   level - v_hold, leak_subtraction, time,
+                                   current))
+                out = self.extract_current(self._padded(current.as_numpy(),
+                                                        stim_stop),
+                                           chord_conductance,
+                                           leak_subtraction,
+                                           delay+shift,t_stop, self.dt,
+                                           level, step=level - v_hold,
+                                           v_hold=v_hold,
+                                           t_read=delay+t_stop)
+                if save_ca:
+                    ca = self._padded(calcium.as_numpy(), stim_stop)
+                    calcium_vals[level][:] = ca[beg: end]
+                current_vals[level][:] = out[beg: end]
+            time = self._padded(time.as_numpy(), stim_stop,
+                                True)[beg: end].copy()
+            return time, current_vals, calcium_vals
 
     def get_activation_SS(self, stimulation_levels: list,
                           v_hold: float, t_stop:float,
@@ -541,13 +1683,19 @@ class ModelPatch(MembranePatch, NModlChannel):
         if len(self.channel_names) > 1:
             electrode_current = True
             chord_conductance = False
-        currents = self.get_activation_traces(stimulation_levels,
-                                              v_hold, t_stop,
-                                              chord_conductance,
-                                              electrode_current,
-                                              save_traces=save_traces,
-                                              save_ca=save_ca)
-        
+        with self._measuring(t_mes):
+            currents = self.get_activation_traces(stimulation_levels,
+                                                  v_hold, t_stop,
+                                                  chord_conductance,
+                                                  electrode_current,
+                                                  save_traces=save_traces,
+                                                  save_ca=save_ca)
+        return self._steady_state(currents, power, t_mes, normalization)
+
+    def _steady_state(self, currents, power, t_mes, normalization):
+        """
+        Normalized peak (or value at t_mes) of currents
+        """
         max_current = self.get_max_of_dict(currents, t_mes, self.dt)
         result = self.normalize_to_one(max_current, normalization)
         if power != 1:
@@ -559,7 +1707,7 @@ class ModelPatch(MembranePatch, NModlChannel):
                                 v_test: float, t_test:float,
                                 chord_conductance,
                                 electrode_current,
-                                save_traces=True, save_ca=True):
+                                save_traces=True, save_ca=True, out=None):
         """
         Function for running step experiments to determine steady-state
         inactivation currents.
@@ -583,96 +1731,128 @@ class ModelPatch(MembranePatch, NModlChannel):
         chord_conductance: boolean
           in many experiments current is normalized by membrane voltage
           minus the ion's reversal potential.
+        out: array
+          (len(stimulation_levels), samples of 2*t_test) array the traces
+          are written to, they are returned as its rows (samples of
+          the whole run for legacy models, see MembranePatch.legacy)
         """
-        delay = t_test
-        shift = 0 # (self.patch.cm/self.patch.g_pas)*1e-3
-
-        if not electrode_current:
-            leak_subtraction = False
-        else:
-            leak_subtraction = True
-        
+        if save_ca and not self._calcium:
+            save_ca = False
+        with self._writing(out):
+            time, current_values, calcium_vals = self._sweep(
+                "_inactivation_sweep", stimulation_levels, v_test, t_test,
+                chord_conductance, electrode_current, save_ca)
         if save_traces:
             fname = self.generate_fname("Inactivation_traces",
                                         min(stimulation_levels),
                                         max(stimulation_levels),
                                         chord_conductance,
                                         electrode_current, False)
-            output = []
-            header = "time"
-        if save_ca and self.ca is None:
-            save_ca = False
+            beg = int(np.round(t_test/self.dt))
+            end = int(np.round(2*t_test/self.dt))
+            self._save_csv(fname, time,
+                           {v_hold: out[beg: end]
+                            for v_hold, out in current_values.items()})
         if save_ca:
             ca_fname = self.generate_fname("Inactivation_traces",
                                            min(stimulation_levels),
                                            max(stimulation_levels),
                                            chord_conductance,
                                            electrode_current, True)
-            calcium_vals = []
-            calcium = h.Vector()
-            calcium.record(self.ca[self.memb_shell].nodes[0]._ref_concentration,
-                           self.dt)
+            self._save_csv(ca_fname, time, calcium_vals)
+        return current_values
+
+    def _inactivation_sweep(self, stimulation_levels, v_test, t_test,
+                            chord_conductance, electrode_current, save_ca):
+        """
+        Inactivation protocol for stimulation_levels. Returns the time
+        of the test pulse, currents from the beginning of the run till
+        the end of the test pulse (till the end of the run, P/N pulses
+        included, for legacy models) and calcium (if save_ca) during
+        the test pulse by level.
+        """
+        delay = t_test
+        if not electrode_current:
+            leak_subtraction = False
         else:
-            ca_fname = ""
-
-        h.celsius = self.temperature
-        stim_start = int(delay/self.dt)
-        current_values = {}
-        current,\
-            chord_conductance = self._record_current(electrode_current,
-                                                     chord_conductance)
-        time = h.Vector()
-        time.record(h._ref_t, self.dt)
-        voltage = h.Vector()
-        voltage.record(self.patch(0.5)._ref_v, self.dt)
-
-        for i, v_hold in enumerate(stimulation_levels):
-            t_stop = self.set_vclamp(delay, v_hold, t_test, v_test,
-                                     leak_subtraction)
-            h.finitialize(v_hold)
-            if self.cvode:
-                h.CVode().re_init()
-            else:
-                h.fcurrent()
-            h.frecord_init()
-            h.continuerun(t_stop)
-            I = current.as_numpy()
-            out = self.extract_current(I,
-                                       chord_conductance,
-                                       leak_subtraction, delay,
-                                       t_test, self.dt,
-                                       v_hold)
-
-            beg = int(np.round(delay/self.dt))
-            end = int(np.round((delay+t_test)/self.dt))
+            leak_subtraction = True
+        beg = int(np.round(delay/self.dt))
+        end = int(np.round((delay+t_test)/self.dt))
+        # samples of the currents
+        size = end
+        t_read = delay + t_test
+        if self.legacy:
+            # channelunit kept the whole run, shorter runs (cached
+            # P/N pulses) are padded with their last sample
+            size = max(self._run_size(self.set_vclamp(delay, v_hold, t_test,
+                                                      v_test,
+                                                      leak_subtraction))
+                       for v_hold in stimulation_levels)
+            t_read = None
+        buffer = self._trace_buffer("_inactivation_sweep",
+                                    len(stimulation_levels), size)
+        if leak_subtraction and self._leak_mode() == "passive":
+            self._leak_template(delay, t_test, self.dt)
+        if (self.batched or self.concatenated) and not self._calcium:
+            clamps = [(delay, v_hold, t_test, v_test)
+                      for v_hold in stimulation_levels]
+            time, currents,\
+                chord_conductance = self._batched_run(
+                    clamps, stimulation_levels, electrode_current,
+                    chord_conductance)
+            current_values = self._windows(stimulation_levels, size, buffer)
+            out = self.extract_currents(
+                _stacked(currents), chord_conductance, leak_subtraction,
+                delay, t_test, self.dt, stimulation_levels,
+                step=[v_test - v_hold for v_hold in stimulation_levels],
+                v_hold=stimulation_levels, t_read=t_read)
+            for v_hold, row in zip(stimulation_levels, out):
+                row = row[:size]
+                current_values[v_hold][:len(row)] = row
+                current_values[v_hold][len(row):] = row[-1]
+            return time[beg: end].copy(), current_values, {}
+        with self.session():
             if save_ca:
-                if not i:
-                    save_time = time.as_numpy().copy()
-                    calcium_vals.append(save_time[beg: end])
-                calcium_vals.append(calcium.as_numpy().copy()[beg: end])
-            if save_traces:
-                if not i:
-                    save_time = time.as_numpy().copy()
-                    output.append(save_time[beg: end])
-                output.append(out[beg: end].copy())
-                header += ";%4.2f" % v_hold
-            current_values[v_hold] = out.copy()
-        if save_traces:
-            path = os.path.join(self.base_directory, "data")
-            if not os.path.exists(path):
-                makedirs(path)
-            path_to_save = os.path.join(path, "%s.csv" % fname)
-            np.savetxt(path_to_save, np.array(output), delimiter=";",
-                       header=header, comments="")
-        if save_ca:
-            path = os.path.join(self.base_directory, "data")
-            if not os.path.exists(path):
-                os.makedirs(path)
-            path_to_save = os.path.join(path, "%s.csv" % ca_fname)
-            np.savetxt(path_to_save, np.array(calcium_vals), delimiter=";",
-                       header=header, comments="")
-        return current_values
-        
+                cal_ref = self.ca[self.memb_shell].nodes[0]._ref_concentration
+                calcium = self._record(cal_ref, self.dt)
+                calcium_vals = self._windows(stimulation_levels, end - beg)
+            else:
+                calcium_vals = {}
+            current_values = self._windows(stimulation_levels, size, buffer)
+            current,\
+                chord_conductance = self._record_current(electrode_current,
+                                                         chord_conductance,
+                                                         self.dt)
+            time = self._record(h._ref_t, self.dt)
+            for v_hold in stimulation_levels:
+                t_stop = self.set_vclamp(delay, v_hold, t_test, v_test,
+                                         leak_subtraction)
+                h.finitialize(v_hold)
+                if self.cvode:
+                    h.CVode().re_init()
+                else:
+                    h.fcurrent()
+                h.frecord_init()
+                h.continuerun(self._watch(delay, t_test, t_stop,
+                                          self._t_mes, v_test - v_hold,
+                                          leak_subtraction, time, current))
+                out = self.extract_current(self._padded(current.as_numpy(),
+                                                        t_stop),
+                                           chord_conductance,
+                                           leak_subtraction, delay,
+                                           t_test, self.dt,
+                                           v_hold, step=v_test - v_hold,
+                                           v_hold=v_hold, t_read=t_read)
+                if save_ca:
+                    ca = self._padded(calcium.as_numpy(), t_stop)
+                    calcium_vals[v_hold][:] = ca[beg: end]
+                out = out[:size]
+                current_values[v_hold][:len(out)] = out
+                current_values[v_hold][len(out):] = out[-1]
+            time = self._padded(time.as_numpy(), t_stop,
+                                True)[beg: end].copy()
+            return time, current_values, calcium_vals
+
     def get_inactivation_SS(self, stimulation_levels: list,
                             v_test: float, t_test:float,
                             power: int, t_mes,
@@ -712,37 +1892,344 @@ class ModelPatch(MembranePatch, NModlChannel):
         if len(self.channel_names) > 1:
             electrode_current = True
             chord_conductance = False
-        currents = self.get_inactivation_traces(stimulation_levels,
-                                                v_test, t_test,
-                                                chord_conductance,
-                                                electrode_current,
-                                                save_traces=save_traces,
-                                                save_ca=save_ca)
-        max_current = self.get_max_of_dict(currents, t_mes, self.dt)
-        result = self.normalize_to_one(max_current, normalization)
-        if power != 1:
-            for key in result.keys():
-                result[key] = result[key]**(1/power)
-        return result
+        with self._measuring(t_mes):
+            currents = self.get_inactivation_traces(
+                stimulation_levels, v_test, t_test, chord_conductance,
+                electrode_current, save_traces=save_traces, save_ca=save_ca)
+        return self._steady_state(currents, power, t_mes, normalization)
+
+    def set_two_pulse_vclamp(self, dur1, v1, dur2, v2, dur3, v3,
+                             leak_subtraction):
+        """
+        Holding at v1 for dur1, conditioning step to v2 for dur2
+        and test pulse to v3 for dur3. There is no room in the clamp
+        for P/N pulses of both steps, the leak is subtracted
+        with the passive template (leak = "passive").
+        """
+        if leak_subtraction and self._leak_mode() != "passive":
+            raise SystemExit('Two pulse protocol subtracts the leak with'
+                             ' leak = "passive" only')
+        self.set_vclamp(dur1, v1, dur2, v2, False)
+        self.vclamp.dur3 = dur3
+        self.vclamp.amp3 = v3 - self.junction
+        # the inactivation traces end with the run
+        return dur1 + dur2 + dur3 + self.dt
+
+    def get_two_pulse_traces(self, stimulation_levels: list,
+                             v_hold: float, t_stop: float,
+                             v_test: float, t_test: float,
+                             act_chord_conductance=False,
+                             inact_chord_conductance=False,
+                             electrode_current=True, save_traces=True):
+        """
+        Activation and inactivation traces from one family of
+        simulations
+
+        Diagram of the experiment:
+              ________________ stimulation_levels
+             |________________|___
+             |________________|   | v_test
+             |________________|   |
+        _____| <- v_hold          |___
+
+        The conditioning step to the stimulation level gives the
+        activation traces (as get_activation_traces), the test pulse
+        the inactivation traces (as get_inactivation_traces, starting
+        t_test before the test pulse). t_test should not be longer
+        than t_stop.
+
+        The inactivation protocol is not the one of
+        get_inactivation_traces: the patch is conditioned for t_stop
+        from the state held at v_hold, not initialized to the steady
+        state of the level. Inactivation traces are the same only when
+        all the gates settle during the conditioning step. Electrode
+        currents differ more, get_inactivation_traces subtracts
+        a baseline starting at the initialization, while the clamp
+        current rises from 0. It saves t_test of simulated time per
+        level, compared to running both protocols.
+
+        Returns dictionaries of activation and inactivation traces
+        """
+        time, traces, calcium = self._sweep(
+            "_two_pulse_sweep", stimulation_levels, v_hold, t_stop,
+            v_test, t_test, act_chord_conductance, inact_chord_conductance,
+            electrode_current)
+        activation = {level: traces[level][0] for level in traces}
+        inactivation = {level: traces[level][1] for level in traces}
+        if save_traces:
+            for suffix, chord, values, t in [
+                    ("Two_pulse_activation_traces", act_chord_conductance,
+                     activation, time[0]),
+                    ("Two_pulse_inactivation_traces",
+                     inact_chord_conductance, inactivation, time[1])]:
+                fname = self.generate_fname(suffix, min(stimulation_levels),
+                                            max(stimulation_levels), chord,
+                                            electrode_current, False)
+                self._save_csv(fname, t, values)
+        return activation, inactivation
+
+    def _two_pulse_sweep(self, stimulation_levels, v_hold, t_stop, v_test,
+                         t_test, act_chord_conductance,
+                         inact_chord_conductance, electrode_current):
+        """
+        Two pulse protocol for stimulation_levels. Returns times of the
+        activation and inactivation traces and the traces by level.
+        """
+        leak_subtraction = bool(electrode_current)
+        clamps = [(t_stop, v_hold, t_stop, level, t_test, v_test)
+                  for level in stimulation_levels]
+        if leak_subtraction and self._leak_mode() == "passive":
+            self._leak_template(t_stop, t_stop, self.dt)
+            self._leak_template(2*t_stop, t_test, self.dt)
+        act_beg = int(np.round(t_stop/self.dt))
+        act_end = int(np.round(2*t_stop/self.dt))
+        inact_beg = int(np.round((2*t_stop - t_test)/self.dt))
+        inact_end = int(np.round((2*t_stop + t_test)/self.dt))
+        activation = self._windows(stimulation_levels, act_end - act_beg)
+        inactivation = self._windows(stimulation_levels,
+                                     inact_end - inact_beg)
+
+        def extract(I, level, chord):
+            # chord is False when the current of several ions is recorded
+            act = self.extract_current(I, act_chord_conductance and chord,
+                                       leak_subtraction, t_stop, t_stop,
+                                       self.dt, level, step=level - v_hold,
+                                       t_read=2*t_stop)
+            inact = self.extract_current(I, inact_chord_conductance
+                                         and chord, leak_subtraction,
+                                         2*t_stop, t_test, self.dt, level,
+                                         step=v_test - level,
+                                         t_read=2*t_stop + t_test)
+            activation[level][:] = act[act_beg: act_end]
+            inactivation[level][:] = inact[inact_beg: inact_end]
+            return activation[level], inactivation[level]
+
+        traces = {}
+        if (self.batched or self.concatenated) and not self._calcium:
+            time, currents, chord = self._batched_run(
+                clamps, [v_hold]*len(clamps), electrode_current, True,
+                "set_two_pulse_vclamp")
+            for level, I in zip(stimulation_levels, currents):
+                traces[level] = extract(I, level, chord)
+        else:
+            with self.session():
+                current, chord = self._record_current(electrode_current,
+                                                      True, self.dt)
+                time = self._record(h._ref_t, self.dt)
+                # the holding phase is the same for all the levels
+                self.set_two_pulse_vclamp(*clamps[0], leak_subtraction)
+                holding = self._checkpoint(v_hold, max(t_stop - h.dt, 0))
+                for level, args in zip(stimulation_levels, clamps):
+                    stim_stop = self.set_two_pulse_vclamp(*args,
+                                                          leak_subtraction)
+                    self._continuerun(holding, stim_stop)
+                    traces[level] = extract(current.as_numpy(), level, chord)
+                time = time.as_numpy().copy()
+        times = (time[act_beg: act_end].copy(),
+                 time[inact_beg: inact_end].copy())
+        return times, traces, {}
+
+    def get_two_pulse_SS(self, act_levels: list, inact_levels: list,
+                         v_hold: float, t_stop: float,
+                         v_test: float, t_test: float,
+                         act_power: int, act_t_mes, act_chord_conductance,
+                         inact_power: int, inact_t_mes,
+                         inact_chord_conductance, electrode_current,
+                         normalization="to_one", save_traces=True):
+        """
+        Steady-state activation and inactivation curves. Levels in
+        both lists are simulated once with the two pulse protocol
+        (see get_two_pulse_traces), the other ones with the activation
+        or inactivation protocol. All the levels are simulated
+        separately if t_test is longer than t_stop. Electrode currents
+        of common levels need the passive leak template (leak =
+        "passive"), P/N pulses cannot follow the two pulse protocol.
+        The inactivation curve can differ from get_inactivation_SS,
+        see get_two_pulse_traces.
+
+        Returns dictionaries of activation and inactivation
+        """
+        if len(self.channel_names) > 1:
+            electrode_current = True
+            act_chord_conductance = False
+            inact_chord_conductance = False
+        common = [level for level in act_levels if level in inact_levels]
+        if t_test > t_stop:
+            common = []
+        if common and electrode_current and self._leak_mode() != "passive":
+            raise SystemExit('Two pulse protocol subtracts the leak with'
+                             ' leak = "passive" only, set leak = "passive"'
+                             ' or simulate the curves separately')
+        activation, inactivation = {}, {}
+        if common:
+            activation, inactivation = self.get_two_pulse_traces(
+                common, v_hold, t_stop, v_test, t_test,
+                act_chord_conductance, inact_chord_conductance,
+                electrode_current, save_traces=save_traces)
+        levels = [level for level in act_levels if level not in common]
+        if levels:
+            with self._measuring(act_t_mes):
+                activation.update(self.get_activation_traces(
+                    levels, v_hold, t_stop, act_chord_conductance,
+                    electrode_current, save_traces=save_traces))
+        levels = [level for level in inact_levels if level not in common]
+        if levels:
+            with self._measuring(inact_t_mes):
+                inactivation.update(self.get_inactivation_traces(
+                    levels, v_test, t_test, inact_chord_conductance,
+                    electrode_current, save_traces=save_traces))
+        activation = {level: activation[level] for level in act_levels}
+        inactivation = {level: inactivation[level] for level in inact_levels}
+        return (self._steady_state(activation, act_power, act_t_mes,
+                                   normalization),
+                self._steady_state(inactivation, inact_power, inact_t_mes,
+                                   normalization))
                 
+    def get_waveform_traces(self, stimulation_levels: list, segments: list,
+                            electrode_current=False, save_traces=True):
+        """
+        Currents evoked by a piecewise-linear command (see
+        set_waveform), e.g. ramps or protocols longer than the twelve
+        segments of the clamp.
+
+        Diagram of a ramp protocol [(20, -90, -90), (100, -90, None)]:
+                         / stimulation_levels
+                       /
+                     /
+        ___________/ <- -90
+
+        stimulation_levels: list
+           list of voltages to test
+        segments: list
+           (duration, start, end) of every segment, start or end None
+           stand for the level
+        electrode_current: boolean
+           the clamp current, the leak is not subtracted
+        """
+        time, current_vals, _ = self._sweep("_waveform_sweep",
+                                            stimulation_levels, segments,
+                                            electrode_current)
+        if save_traces:
+            fname = self.generate_fname("Waveform_traces",
+                                        min(stimulation_levels),
+                                        max(stimulation_levels),
+                                        False, electrode_current, False)
+            self._save_csv(fname, time, current_vals)
+        return current_vals
+
+    def _waveform_sweep(self, stimulation_levels, segments,
+                        electrode_current):
+        """
+        Command of segments for stimulation_levels. Returns the time
+        and the currents by level.
+        """
+        current_vals = {}
+        with self.session():
+            current, _ = self._record_current(electrode_current, False,
+                                              self.dt)
+            time = self._record(h._ref_t, self.dt)
+            try:
+                for level in stimulation_levels:
+                    command = [(dur, level if start is None else start,
+                                level if end is None else end)
+                               for dur, start, end in segments]
+                    t_stop = self.set_waveform(command)
+                    h.finitialize(command[0][1])
+                    if self.cvode:
+                        h.CVode().re_init()
+                    else:
+                        h.fcurrent()
+                    h.frecord_init()
+                    h.continuerun(t_stop)
+                    out = self.extract_current(current.as_numpy(), False,
+                                               False, 0, 0, self.dt)
+                    # the command of every level lasts as long
+                    if not current_vals:
+                        current_vals = self._windows(stimulation_levels,
+                                                     len(out))
+                    current_vals[level][:] = out
+            finally:
+                self._stop_waveform()
+            time = time.as_numpy().copy()
+        return time, current_vals, {}
+
     def extract_current(self, I, chord_conductance, leak_subtraction, dur1,
-                        dur2, dt, v=None, filtering=True):
+                        dur2, dt, v=None, filtering=True, step=None,
+                        v_hold=None, t_read=None):
+        """
+        step (mV) of the clamp after dur1 is needed to scale
+        the passive leak (leak = "passive"), v_hold and step
+        to find the cached P/N pulse (leak = "cached"). With t_read
+        (ms) only the current till t_read (and the P/N pulses) is
+        filtered and returned.
+        """
+        return self.extract_currents(np.asarray(I)[np.newaxis],
+                                     chord_conductance, leak_subtraction,
+                                     dur1, dur2, dt, v, filtering, step,
+                                     v_hold, t_read)[0]
+
+    def extract_currents(self, I, chord_conductance, leak_subtraction,
+                         dur1, dur2, dt, v=None, filtering=True, step=None,
+                         v_hold=None, t_read=None):
+        """
+        extract_current of the currents of a sweep at once, I is
+        a (levels, samples) array. v, step and v_hold are values
+        by row or one value for all the rows.
+        """
+        rows = len(I)
         if v is None:
-            v= self.patch.e_pas
+            v = self.patch.e_pas
+        steps = _by_row(step, rows)
+        missing = []
+        if leak_subtraction and self._leak_mode() != "passive":
+            keys = [self._pn_key(hold, st, dur1, dur2, dt) for hold, st
+                    in zip(_by_row(v_hold, rows), steps)]
+            missing = [i for i, key in enumerate(keys)
+                       if key not in self._pn_templates]
+        # the filter is causal, samples after the ones read (P/N
+        # pulses included) are not needed
+        if t_read is not None and not missing:
+            I = I[..., :int(np.round(t_read/dt))]
         if filtering:
-            filter_current = lfilter(self.f_b, self.f_a, I)
+            filter_current = self._filter(I)
         else:
-            filter_current = I.copy()
+            # copied by curr_stim_response
+            filter_current = I
         current = self.curr_stim_response(filter_current, dur1, dur2, dt,
                                           leak_subtraction)
         #either step injection or the short pulse
         if leak_subtraction:
-            beg = int(dur1/dt)
-            end = int((dur1+dur2)/dt)
-            pulse = self.curr_leak_amp(filter_current, dur1, dur2, dt)
-            current[beg:end] = current[beg:end] - pulse
+            beg = int(np.round(dur1/dt))
+            end = int(np.round((dur1+dur2)/dt))
+            if self._leak_mode() == "passive":
+                if None in steps:
+                    raise SystemExit("Passive leak subtraction needs"
+                                     " the clamp step")
+                template = self._leak_template(dur1, dur2, dt)
+                if filtering:
+                    template = self._filter(template)
+                template = self.curr_stim_response(template, dur1, dur2,
+                                                   dt, True)
+                pulse = np.multiply.outer(steps, template[beg:end])
+            else:
+                pulse = np.empty((rows, end - beg))
+                if len(missing) == rows:
+                    pulse[:] = self.curr_leak_amp(filter_current, dur1,
+                                                  dur2, dt)
+                elif missing:
+                    pulse[missing] = self.curr_leak_amp(
+                        filter_current[missing], dur1, dur2, dt)
+                # rows with the same key get the pulse of the first one
+                for i, key in enumerate(keys):
+                    if key in self._pn_templates:
+                        pulse[i] = self._pn_templates[key]
+                    elif key is not None:
+                        self._pn_templates[key] = pulse[i].copy()
+            current[..., beg:end] -= pulse
         if chord_conductance:
-            current = current/(v - self.E_rev[self.ion_names[0]])
+            driving = np.array(_by_row(v, rows), dtype=float)
+            current = current/(driving
+                               - self.E_rev[self.ion_names[0]])[:, None]
         return current
 
     @staticmethod
@@ -775,7 +2262,7 @@ class ModelPatch(MembranePatch, NModlChannel):
                 else:
                     new_current[key] = max(current[key])
             else:
-                 new_current[key] = current[key][int(t_mes/dt)]
+                 new_current[key] = current[key][int(np.round(t_mes/dt))]
         return new_current
 
     
@@ -844,6 +2331,8 @@ class ModelPatch(MembranePatch, NModlChannel):
 
 
 class ModelPatchCa(ModelPatch):
+    _calcium = True
+
     def __init__(self, path_to_mods: str, channel_names: list, ion_names: list,
                  external_conc: dict, internal_conc: dict, E_rev: dict,
                  gbar_names: dict, gbar_values: dict,
@@ -852,7 +2341,6 @@ class ModelPatchCa(ModelPatch):
                  sim_dt, t_decay, L, diam, Ra,
                  buffer_capacity,
                  membrane_shell_width):
-
         if not directory:
             directory = "validation_results"
         super(ModelPatchCa, self).__init__(path_to_mods, channel_names,
@@ -870,39 +2358,100 @@ class ModelPatchCa(ModelPatch):
         self.t_decay = t_decay
         self.Kb = buffer_capacity
         self.memb_shell_width = membrane_shell_width
-        self.geom = rxd.Shell(1- self.memb_shell_width, 1)
-        self.memb_shell = rxd.Region(self.patch,
-                                     geometry=self.geom,
-                                     nrn_region="i",
-                                     name="membrane_shell")
-        old_saf = self.geom.surface_areas1d
-        self.geom.surface_areas1d = lambda sec: old_saf(sec)/self.Kb
         if "ca" in self.ion_names:
-            self.ca = rxd.Species(self.memb_shell, d=0.2,
-                                  name='ca', charge=2,
-                                  initial=self._cai,
-                                  atolscale=1e-9)
+            self._ca_initial = self._cai
             h.cao0_ca_ion = self.external_conc["Ca"]
 
         elif "ba" in self.ion_names:
-            self.ca = rxd.Species(self.memb_shell, d=0.2,
-                                  name='ca', charge=2,
-                                  initial=0,
-                                  atolscale=1e-9)
+            self._ca_initial = 0
             if "ba" not in internal_conc:
                 self._cai = 0
             self.E_rev["ca"] = None
             h.cao0_ca_ion = self.external_conc["Ca"]
             for channel_name in self.channel_names:
-                chan = self.patch.psection()["density_mechs"][channel_name]
+                gbar_name = self.gbar_names[channel_name]
+                gbar = self._values(gbar_name, channel_name)
                 for i, seg in enumerate(self.patch):
                     from_mech = getattr(seg, channel_name)
-                    gbar_val = 2*chan[self.gbar_names[channel_name]][i]
-                    setattr(from_mech, self.gbar_names[channel_name], gbar_val)
-        
-        self.decay_eq = (self._cai - self.ca)/self.t_decay
+                    setattr(from_mech, gbar_name, 2*gbar[i])
+        # calcium decays to the concentration set at the start
+        self._ca_rest = self._cai
+        self._add_rxd()
+        # rxd adds the ion to the patch
+        self._description = None
+
+    def _add_rxd(self):
+        """
+        Calcium shell of the patch, with buffering and decay
+        """
+        from neuron import rxd
+
+        self.geom = rxd.Shell(1- self.memb_shell_width, 1)
+        self.memb_shell = rxd.Region(self.patch,
+                                     geometry=self.geom,
+                                     nrn_region="i",
+                                     name="membrane_shell")
+        old_saf = self.geom.surface_areas1d
+        self.geom.surface_areas1d = lambda sec: old_saf(sec)/self.Kb
+        self.ca = rxd.Species(self.memb_shell, d=0.2,
+                              name='ca', charge=2,
+                              initial=self._ca_initial,
+                              atolscale=1e-9)
+        self.decay_eq = (self._ca_rest - self.ca)/self.t_decay
         self.ca_decay = rxd.Rate(self.ca, self.decay_eq)
 
+    def _drop_shape(self):
+        # rxd needs the 3D points of the shell
+        pass
+
+    def _remove_rxd(self):
+        """
+        Delete the rxd objects of _add_rxd, before the section of
+        the patch
+        """
+        self.ca_decay = self.decay_eq = self.ca = None
+        self.memb_shell = self.geom = None
+
+    @staticmethod
+    def _reindex_rxd():
+        from neuron.rxd import rxd
+
+        # rxd does not update the indices of the remaining species
+        # when one is deleted
+        rxd._update_node_data(True, True)
+
+    def _park(self):
+        # rxd has no way to leave species out of the integration
+        self._remove_rxd()
+        super(ModelPatchCa, self)._park()
+        self._reindex_rxd()
+
+    def _unpark(self):
+        super(ModelPatchCa, self)._unpark()
+        self._add_rxd()
+
+    def _save_state(self):
+        from neuron import rxd
+
+        # SaveState leaves out rxd concentrations
+        return super(ModelPatchCa, self)._save_state(), rxd.save_state()
+
+    def _restore_state(self, state):
+        from neuron import rxd
+
+        super(ModelPatchCa, self)._restore_state(state[0])
+        rxd.restore_state(state[1])
+
+    def _nrn_globals(self):
+        nrn_globals = super(ModelPatchCa, self)._nrn_globals()
+        nrn_globals["cao0_ca_ion"] = self.external_conc["Ca"]
+        return nrn_globals
+
+    def close(self):
+        self._remove_rxd()
+        super(ModelPatchCa, self).close()
+        self._reindex_rxd()
+
     @property
     def cai(self):
         if "ca" in self.ion_names:
@@ -28,6 +28,18 @@ class NModlChannel(sciunit.Capability):
 
         raise NotImplementedError()
 
+    def get_two_pulse_SS(self, act_levels: list, inact_levels: list,
+                         v_hold: float, t_stop: float,
+                         v_test: float, t_test: float,
+                         act_power: int, act_t_mes, act_chord_conductance,
+                         inact_power: int, inact_t_mes,
+                         inact_chord_conductance, electrode_current,
+                         normalization="to_one", save_traces=True):
+        """This function must be implemented by the patch model class.
+        """
+
+        raise NotImplementedError()
+
     def get_activation_traces(self, stimulation_levels: list,
                               v_hold: float, t_stop:float,
                               chord_conductance=False,
@@ -0,0 +1,57 @@
+"""
+Low-pass Bessel filters of patch clamp amplifiers applied to simulated
+currents. Designs are cached as second-order sections, stable at any
+order and cutoff, unlike the (b, a) form of high order filters with
+cutoffs far below the sampling rate.
+"""
+import functools
+
+
+ORDER = 8  # poles, of an external 8-pole Bessel filter
+
+
+@functools.lru_cache()
+def bessel_sos(order, cutoff, fs):
+    """
+    Second-order sections of a low-pass Bessel filter with order
+    poles and cutoff (kHz) for currents sampled at fs (kHz), designed
+    once for every (order, cutoff, fs) and shared by all the models,
+    not to be modified
+    """
+    if cutoff >= fs/2:
+        raise SystemExit("Filter cutoff %g kHz has to be below half"
+                         " the sampling rate %g kHz" % (cutoff, fs))
+    from scipy.signal import bessel
+    return bessel(order, cutoff, btype="low", analog=False, norm="mag",
+                  fs=fs, output="sos")
+
+
+@functools.lru_cache()
+def bessel_ba(order, cutoff, fs):
+    """
+    The filter of bessel_sos as (b, a) polynomials, designed
+    directly as channelunit did before second-order sections
+    """
+    # checks the cutoff
+    bessel_sos(order, cutoff, fs)
+    from scipy.signal import bessel
+    return bessel(order, cutoff, btype="low", analog=False, norm="mag",
+                  fs=fs, output="ba")
+
+
+def apply(sos, values):
+    """
+    values filtered along the last axis, every row (of any leading
+    dimensions) is a separate recording
+    """
+    from scipy.signal import sosfilt
+    return sosfilt(sos, values, axis=-1)
+
+
+def apply_ba(ba, values):
+    """
+    values filtered with (b, a) polynomials along the last axis,
+    as channelunit did before second-order sections
+    """
+    from scipy.signal import lfilter
+    return lfilter(*ba, values, axis=-1)
@@ -0,0 +1,204 @@
+import os
+import shutil
+import hashlib
+import platform
+import tempfile
+import threading
+from subprocess import run
+
+from channelunit.nmodl import mechanism_index
+
+
+MOD_EXTENSIONS = (".mod", ".inc")
+# environment variables that change what nrnivmodl produces
+BUILD_ENV = ("CC", "CXX", "CFLAGS", "CXXFLAGS", "CPPFLAGS", "LDFLAGS")
+# channelunit's own mechanisms (the clamp)
+CLAMP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "mechanisms")
+
+# mod directory -> directory the compiled mechanisms were loaded from
+_loaded = {}
+# mechanism name -> mod directory it was loaded from
+_mechanism_dirs = {}
+_lock = threading.Lock()
+
+
+def cache_path():
+    """
+    Directory holding the compiled mechanisms. Defaults to
+    ~/.cache/channelunit, set CHANNELUNIT_CACHE to use another one.
+    """
+    path = os.environ.get("CHANNELUNIT_CACHE")
+    if path:
+        return path
+    base = os.environ.get("XDG_CACHE_HOME",
+                          os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "channelunit")
+
+
+def coreneuron():
+    """
+    Whether mechanisms are also built for CoreNEURON. Set
+    CHANNELUNIT_CORENEURON=1 before the first model is made.
+    """
+    return os.environ.get("CHANNELUNIT_CORENEURON", "") not in ["", "0"]
+
+
+def build_paths(path):
+    """
+    Mod directories compiled together for path. CoreNEURON loads
+    a single library, so for CoreNEURON the clamp is built with
+    the channels.
+    """
+    paths = [path]
+    clamp = os.path.realpath(CLAMP_PATH)
+    if coreneuron() and os.path.realpath(path) != clamp:
+        paths.append(CLAMP_PATH)
+    return paths
+
+
+def mod_files(path):
+    return sorted(fname for fname in os.listdir(path)
+                  if fname.endswith(MOD_EXTENSIONS))
+
+
+def mechanisms_hash(path):
+    """
+    Hash of the mod sources in path, the NEURON version, nrnivmodl
+    used, the compiler flags and whether it is built for CoreNEURON.
+    """
+    import neuron
+    digest = hashlib.sha256()
+    digest.update(neuron.__version__.encode())
+    digest.update(str(shutil.which("nrnivmodl")).encode())
+    for var in BUILD_ENV:
+        digest.update(("%s=%s;" % (var, os.environ.get(var, ""))).encode())
+    if coreneuron():
+        digest.update(b"coreneuron;")
+    for mod_path in build_paths(path):
+        for fname in mod_files(mod_path):
+            digest.update(fname.encode())
+            with open(os.path.join(mod_path, fname), "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def compiled_library(path, name="nrnmech"):
+    """
+    Path to library name (nrnmech or corenrnmech) compiled in path,
+    None if there is none
+    """
+    import neuron
+    libname = "%s%s%s" % (neuron.mechanism_prefix, name,
+                          neuron.mechanism_suffix)
+    for arch in [platform.machine(), "i686", "x86_64", "powerpc", "umac"]:
+        if os.path.exists(os.path.join(path, arch, libname)):
+            return os.path.join(path, arch, libname)
+    return None
+
+
+def is_compiled(path):
+    if compiled_library(path) is None:
+        return False
+    return not coreneuron() or compiled_library(path,
+                                                "corenrnmech") is not None
+
+
+def compile_mechanisms(path, recompile=True):
+    """
+    Returns the directory with compiled mechanisms from path.
+
+    Mechanisms are compiled once into cache_path()/<mechanisms_hash>
+    and reused as long as the sources, NEURON and the compiler flags
+    stay the same. With recompile False nothing is compiled, the cached
+    build is used if there is one, otherwise mechanisms compiled
+    in path.
+
+    path is only read. The mod files are copied to a private
+    directory, compiled there and the finished build is renamed into
+    place, so many threads and processes can compile the same
+    mechanisms at once without changing the working directory.
+    """
+    cache = cache_path()
+    build_dir = os.path.join(cache, mechanisms_hash(path))
+    if is_compiled(build_dir):
+        return build_dir
+    if not recompile:
+        return path
+    os.makedirs(cache, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(build_dir) + ".",
+                               dir=cache)
+    try:
+        for mod_path in build_paths(path):
+            for fname in mod_files(mod_path):
+                shutil.copy2(os.path.join(mod_path, fname), tmp_dir)
+        command = ["nrnivmodl"]
+        if coreneuron():
+            command.append("-coreneuron")
+        p = run(command, cwd=tmp_dir, capture_output=True, text=True)
+        if p.returncode or not is_compiled(tmp_dir):
+            raise SystemExit("Unable to compile mechanisms from %s:\n%s"
+                             % (path, p.stdout + p.stderr))
+        if os.path.isdir(build_dir) and not is_compiled(build_dir):
+            # left over by an interrupted build
+            shutil.rmtree(build_dir, ignore_errors=True)
+        try:
+            os.rename(tmp_dir, build_dir)
+        except OSError:
+            # somebody else finished first
+            if not is_compiled(build_dir):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return build_dir
+
+
+def mechanism_names(path):
+    """
+    Names (SUFFIX, POINT_PROCESS, ARTIFICIAL_CELL) of mechanisms
+    defined by the mod files in path.
+    """
+    return list(mechanism_index(path))
+
+
+def load_mechanisms(path, recompile=True):
+    """
+    Compiles (see compile_mechanisms) and loads mechanisms from path.
+    Every directory is loaded only once per process, later calls
+    return straight away. Raises SystemExit if path defines a mechanism
+    that was already loaded from another directory.
+
+    For CoreNEURON (see coreneuron) CORENEURONLIB is pointed to
+    the first library loaded with the clamp.
+    """
+    import neuron
+    path = os.path.realpath(path)
+    with _lock:
+        if path in _loaded:
+            return _loaded[path]
+        build_dir = os.path.join(cache_path(), mechanisms_hash(path))
+        if build_dir in _loaded.values():
+            # the same mod files were already loaded from another directory
+            _loaded[path] = build_dir
+            return build_dir
+        names = []
+        for mod_path in build_paths(path):
+            names.extend(mechanism_names(mod_path))
+        for name in names:
+            if name in _mechanism_dirs:
+                raise SystemExit("Unable to load %s from %s, it is already"
+                                 " loaded from %s"
+                                 % (name, path, _mechanism_dirs[name]))
+        build_dir = compile_mechanisms(path, recompile)
+        if not neuron.load_mechanisms(build_dir,
+                                      warn_if_already_loaded=False):
+            raise SystemExit("Unable to load mechanisms from %s" % path)
+        for name in names:
+            _mechanism_dirs[name] = path
+        _loaded[path] = build_dir
+        if coreneuron():
+            # the clamp came with the channels
+            _loaded.setdefault(os.path.realpath(CLAMP_PATH), build_dir)
+            os.environ.setdefault("CORENEURONLIB",
+                                  compiled_library(build_dir, "corenrnmech"))
+        return build_dir
@@ -0,0 +1,161 @@
+import os
+import re
+import hashlib
+
+
+# NEURON block statements taking a list of names
+LIST_KEYWORDS = ["RANGE", "GLOBAL", "NONSPECIFIC_CURRENT",
+                 "ELECTRODE_CURRENT", "POINTER", "BBCOREPOINTER", "EXTERNAL"]
+KINDS = ["SUFFIX", "POINT_PROCESS", "ARTIFICIAL_CELL"]
+# likely names of the maximal conductance (or permeability)
+CONDUCTANCE = re.compile(r"^[gp]\w*(bar|max)\w*$", re.IGNORECASE)
+NUMBER = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+
+# sha256 of a mod file -> its description
+_parsed = {}
+
+
+def strip_comments(text):
+    """
+    text without COMMENT blocks, : and ? comments, TITLE lines and
+    the C code of VERBATIM blocks (only the VERBATIM keyword is kept)
+    """
+    # some files still have old Mac line endings
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = re.sub(r"(?ms)^\s*COMMENT\b.*?^\s*ENDCOMMENT\b", "", text)
+    text = re.sub(r"(?ms)^(\s*VERBATIM\b).*?^\s*ENDVERBATIM\b", r"\1",
+                  text)
+    text = re.sub(r"(?m)^\s*TITLE\b.*", "", text)
+    return re.sub(r"[:?].*", "", text)
+
+
+def block(text, name):
+    """
+    Body of the first block called name (NEURON, PARAMETER,...)
+    starting a line, None if there is no such block.
+    """
+    match = re.search(r"(?m)^\s*%s\b[^{}]*\{" % name, text)
+    if match is None:
+        return None
+    depth = 1
+    for i in range(match.end(), len(text)):
+        if text[i] == "{":
+            depth += 1
+        elif text[i] == "}":
+            depth -= 1
+            if not depth:
+                return text[match.end():i]
+    return text[match.end():]
+
+
+def parse_neuron_block(body, mech):
+    keyword = None
+    ion = None
+    for token in re.findall(r"[A-Za-z_]\w*|%s" % NUMBER, body):
+        if token in KINDS:
+            mech["kind"] = token
+            keyword = token
+        elif token == "USEION":
+            keyword = token
+        elif token in ["READ", "WRITE", "VALENCE"] and ion is not None:
+            keyword = token
+        elif token in LIST_KEYWORDS:
+            keyword = token
+            ion = None
+        elif token == "THREADSAFE":
+            mech["threadsafe"] = True
+            keyword = None
+        elif token == "REPRESENTS":
+            keyword = None
+        elif keyword in KINDS:
+            mech["name"] = token
+            keyword = None
+        elif keyword == "USEION":
+            ion = mech["ions"].setdefault(token, {"read": [], "write": [],
+                                                  "valence": None})
+            keyword = None
+        elif keyword in ["READ", "WRITE"]:
+            ion[keyword.lower()].append(token)
+        elif keyword == "VALENCE":
+            ion["valence"] = float(token)
+            keyword = None
+        elif keyword in LIST_KEYWORDS:
+            mech[keyword.lower()].append(token)
+
+
+def parse_mod(text):
+    """
+    Static description of a mod file: name, kind (SUFFIX,
+    POINT_PROCESS, ARTIFICIAL_CELL), ions with variables read and
+    written, RANGE and GLOBAL variables, PARAMETERs with their
+    defaults, STATEs, likely conductance names and whether it has
+    KINETIC, DERIVATIVE or VERBATIM blocks and is THREADSAFE.
+    """
+    text = strip_comments(text)
+    mech = {"name": None, "kind": None, "ions": {}, "threadsafe": False}
+    for keyword in LIST_KEYWORDS:
+        mech[keyword.lower()] = []
+    body = block(text, "NEURON")
+    if body is not None:
+        parse_neuron_block(body, mech)
+    mech["parameters"] = {}
+    body = block(text, "PARAMETER")
+    if body is not None:
+        for name, value in re.findall(r"([A-Za-z_]\w*)(?:\s*=\s*(%s))?"
+                                      r"(?:\s*\([^)]*\))?(?:\s*<[^>]*>)?"
+                                      % NUMBER, body):
+            mech["parameters"][name] = float(value) if value else None
+    body = block(text, "STATE")
+    mech["states"] = []
+    if body is not None:
+        body = re.sub(r"\([^)]*\)|<[^>]*>|\bFROM\b.*?\bTO\b\s*\S+", "", body)
+        mech["states"] = re.findall(r"[A-Za-z_]\w*", body)
+    mech["conductances"] = [name for name in mech["range"]
+                            if name in mech["parameters"]
+                            and CONDUCTANCE.match(name)]
+    mech["kinetic"] = re.search(r"(?m)^\s*KINETIC\s+\w+\s*\{",
+                                text) is not None
+    mech["derivative"] = re.search(r"(?m)^\s*DERIVATIVE\s+\w+\s*\{",
+                                   text) is not None
+    mech["verbatim"] = re.search(r"(?m)^\s*VERBATIM\b", text) is not None
+    return mech
+
+
+def thread_safe(mech):
+    """
+    Whether NEURON can run mech in several threads: it is declared
+    THREADSAFE or it has no VERBATIM code and no GLOBALs other than
+    PARAMETERs (assigned GLOBALs are shared by the threads).
+    """
+    if mech["threadsafe"]:
+        return True
+    if mech["verbatim"]:
+        return False
+    return all(name in mech["parameters"] for name in mech["global"])
+
+
+def parse_file(fname):
+    """
+    parse_mod for a file, cached by the hash of its content
+    """
+    with open(fname, "rb") as f:
+        content = f.read()
+    key = hashlib.sha256(content).hexdigest()
+    if key not in _parsed:
+        _parsed[key] = parse_mod(content.decode("utf-8", errors="replace"))
+    return _parsed[key]
+
+
+def mechanism_index(path):
+    """
+    Mechanisms defined by mod files in path, name -> parse_mod
+    description. NEURON is not needed.
+    """
+    index = {}
+    for fname in sorted(os.listdir(path)):
+        if not fname.endswith(".mod"):
+            continue
+        mech = parse_file(os.path.join(path, fname))
+        if mech["name"] is not None:
+            index[mech["name"]] = dict(mech, file=fname)
+    return index
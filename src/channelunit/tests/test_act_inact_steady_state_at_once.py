@@ -1,6 +1,5 @@
 import os
 from collections import OrderedDict
-import matplotlib.pyplot as plt
 from sciunit import Test, Score
 
 
@@ -18,11 +17,19 @@ class SteadyStateTest(Test):
     observation: a dictonary with "Activation" and "Inactivation" keys. 
           Values are dictionaries of experimental observations in the form:
           key: applied voltage, value: activation value
+    two_pulse: voltages of both curves are simulated once, the activation
+          step followed by the inactivation test pulse
+          (see get_two_pulse_SS). It is a different inactivation
+          protocol, conditioning at the voltage starts from v_init and
+          lasts the activation step, inactivation has to settle during
+          the step. P/N pulses cannot follow the protocol, electrode
+          currents need a model with leak = "passive". The test pulse
+          cannot be longer than the activation step.
     """
     def __init__(self, observation: dict, experimental_conditions: dict,
                  name, electrode_current, normalization,
                  power={"Activation": 1, "Inactivation": 1},
-                 base_directory="", save_figures=True):
+                 base_directory="", save_figures=True, two_pulse=False):
         act_obs = observation["Activation"]
         act_cond = experimental_conditions["Activation"]
         act_cond["electrode_current"] = electrode_current
@@ -44,6 +51,10 @@ class SteadyStateTest(Test):
                                                                  "Inactivation"),
                                                     base_directory,
                                                     save_figures=False)
+        if two_pulse and self.inact_test.t_test > self.act_test.t_stop:
+            raise SystemExit("two_pulse needs an inactivation test pulse"
+                             " (t_test) not longer than the activation"
+                             " step (t_stop)")
         observation = {"Activation": self.act_test.observation,
                        "Inactivation": self.inact_test.observation}
         super(SteadyStateTest, self).__init__(observation, name)
@@ -53,6 +64,7 @@ class SteadyStateTest(Test):
         self.required_capabilities += (NModlChannel,)
         self.base_directory = base_directory
         self.save_figures = save_figures
+        self.two_pulse = two_pulse
         self.score_type = ZScore_BothSteadyStateCurves
         self.dpi = 200
     
@@ -68,23 +80,33 @@ class SteadyStateTest(Test):
                   inact_v_test, inact_t_test,
                   inact_power,  inact_chord_conductance,
                   electrode_current, normalization):
-        act_prediction = model.get_activation_SS(act_stim_list,
-                                                 act_v_init, act_t_stop,
-                                                 act_power,
-                                                 act_chord_conductance,
-                                                 electrode_current,
-                                                 normalization,
-                                                 save_traces=False,
-                                                 save_ca=False)
-        inact_prediction = model.get_inactivation_SS(inact_stim_list,
-                                                     inact_v_test,
-                                                     inact_t_test,
-                                                     inact_power,
-                                                     inact_chord_conductance,
+        if self.two_pulse:
+            # one recording, sampled and filtered as the activation
+            with self.act_test.sampling(model):
+                act_prediction, inact_prediction = model.get_two_pulse_SS(
+                    act_stim_list, inact_stim_list, act_v_init, act_t_stop,
+                    inact_v_test, inact_t_test, act_power,
+                    self.act_test.t_mes, act_chord_conductance, inact_power,
+                    self.inact_test.t_mes, inact_chord_conductance,
+                    electrode_current, normalization, save_traces=False)
+            return {"Activation": act_prediction,
+                    "Inactivation": inact_prediction}
+        with self.act_test.sampling(model):
+            act_prediction = model.get_activation_SS(act_stim_list,
+                                                     act_v_init, act_t_stop,
+                                                     act_power,
+                                                     self.act_test.t_mes,
+                                                     act_chord_conductance,
                                                      electrode_current,
                                                      normalization,
                                                      save_traces=False,
                                                      save_ca=False)
+        with self.inact_test.sampling(model):
+            inact_prediction = model.get_inactivation_SS(
+                inact_stim_list, inact_v_test, inact_t_test, inact_power,
+                self.inact_test.t_mes, inact_chord_conductance,
+                electrode_current, normalization, save_traces=False,
+                save_ca=False)
         return {"Activation": act_prediction,
                 "Inactivation": inact_prediction}
     
@@ -126,6 +148,7 @@ class SteadyStateTest(Test):
             os.makedirs(path)
 
 
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots(1, 1)
         
         act_v = list(observations["Activation"].keys())
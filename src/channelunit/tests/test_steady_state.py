@@ -1,6 +1,5 @@
 import os
 from collections import OrderedDict
-import matplotlib.pyplot as plt
 from sciunit import Test, Score
 
 
@@ -70,6 +69,22 @@ class BaseSteadyStateTest(Test):
         self.score_type = ZScore_SteadyStateCurves
         self.dpi = 200
 
+    def set_sampling(self, experimental_conditions):
+        """
+        sampling_rate (kHz), filter_cutoff (kHz) and filter_order
+        of the recording, e.g. a 10 kHz or 2 kHz Bessel filter. The
+        settings of the model are used for the ones not provided.
+        """
+        for name in ["sampling_rate", "filter_cutoff", "filter_order"]:
+            try:
+                setattr(self, name, experimental_conditions[name])
+            except KeyError:
+                setattr(self, name, None)
+
+    def sampling(self, model):
+        return model.sampling(self.sampling_rate, self.filter_cutoff,
+                              self.filter_order)
+
     def compute_score(self, observation, prediction, verbose=False):
         score_avg, errors = ZScore_SteadyStateCurves.compute(observation,
                                                              prediction)
@@ -106,6 +121,7 @@ class BaseSteadyStateTest(Test):
         if not os.path.exists(path):
             os.makedirs(path)
 
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots(1, 1)
         label = ""
         for n in model.channel_names:
@@ -151,6 +167,7 @@ class ActivationSteadyStateTest(BaseSteadyStateTest):
             self.normalization = experimental_conditions["normalization"]
         except KeyError:
             raise SystemExit("It must be specified, if currents normalized to_one")    
+        self.set_sampling(experimental_conditions)
         self.power = power
         self.observation = OrderedDict(sorted(self.observation.items()))
         self.stimulus_list = self.extract_stimulation(self.observation)
@@ -166,12 +183,12 @@ class ActivationSteadyStateTest(BaseSteadyStateTest):
     
 
     def generate_prediction(self, model, verbose=False):
-        
-        prediction = self.run_model(model, self.stimulus_list, self.v_init,
-                                    self.t_stop, self.power, self.t_mes,
-                                    self.chord_conductance,
-                                    self.electrode_current,
-                                    self.normalization)
+        with self.sampling(model):
+            prediction = self.run_model(model, self.stimulus_list,
+                                        self.v_init, self.t_stop, self.power,
+                                        self.t_mes, self.chord_conductance,
+                                        self.electrode_current,
+                                        self.normalization)
         if self.save_figures:
             name = self.name.replace(" ", "_")
             self.generate_figures(model, self.observation, prediction,
@@ -213,6 +230,7 @@ class InactivationSteadyStateTest(BaseSteadyStateTest):
             self.normalization = experimental_conditions["normalization"]
         except KeyError:
             raise SystemExit("It must be specified, if currents normalized to_one")    
+        self.set_sampling(experimental_conditions)
         self.power = power
         self.observation = OrderedDict(sorted(self.observation.items()))
         self.stimulus_list = self.extract_stimulation(self.observation)
@@ -227,12 +245,12 @@ class InactivationSteadyStateTest(BaseSteadyStateTest):
     
 
     def generate_prediction(self, model, verbose=False):
-        
-        prediction = self.run_model(model, self.stimulus_list, self.v_test,
-                                    self.t_test, self.power, self.t_mes,
-                                    self.chord_conductance,
-                                    self.electrode_current,
-                                    self.normalization)
+        with self.sampling(model):
+            prediction = self.run_model(model, self.stimulus_list,
+                                        self.v_test, self.t_test, self.power,
+                                        self.t_mes, self.chord_conductance,
+                                        self.electrode_current,
+                                        self.normalization)
         if self.save_figures:
             name = self.name.replace(" ", "_")
             self.generate_figures(model, self.observation, prediction,
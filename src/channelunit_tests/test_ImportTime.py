@@ -0,0 +1,55 @@
+import sys
+import unittest
+from subprocess import run
+
+IMPORT_BUDGET = 0.5  # s
+HEAVY = ["neuron", "neuron.rxd", "scipy.signal", "matplotlib", "sciunit"]
+
+script = """
+import sys
+import time
+t = time.perf_counter()
+%s
+print(time.perf_counter() - t)
+print(" ".join(m for m in %r if m in sys.modules))
+"""
+
+
+def import_in_subprocess(statement):
+    p = run([sys.executable, "-c", script % (statement, HEAVY)],
+            capture_output=True, text=True, check=True)
+    lines = p.stdout.splitlines()
+    return float(lines[-2]), lines[-1].split()
+
+
+class TestImportTime(unittest.TestCase):
+    def test_import_budget(self):
+        duration, loaded = import_in_subprocess("import channelunit")
+        self.assertLess(duration, IMPORT_BUDGET)
+
+    def test_import_no_heavy_modules(self):
+        duration, loaded = import_in_subprocess("import channelunit")
+        self.assertEqual([], loaded)
+
+    def test_import_model(self):
+        duration, loaded = import_in_subprocess(
+            "from channelunit import ModelWholeCellPatch")
+        self.assertEqual(["neuron", "sciunit"], loaded)
+
+    def test_import_tests(self):
+        duration, loaded = import_in_subprocess("import channelunit.tests")
+        self.assertNotIn("matplotlib", loaded)
+        self.assertNotIn("neuron", loaded)
+
+    def test_import_nmodl(self):
+        duration, loaded = import_in_subprocess(
+            "from channelunit.nmodl import mechanism_index")
+        self.assertEqual([], loaded)
+
+    def test_unknown_attribute(self):
+        import channelunit
+        self.assertRaises(AttributeError, getattr, channelunit, "Model")
+
+
+if __name__ == "__main__":
+    unittest.main()
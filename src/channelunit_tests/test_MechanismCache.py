@@ -0,0 +1,151 @@
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from channelunit import mechanisms_path
+from channelunit import data_path
+from channelunit.mechanism_cache import CLAMP_PATH
+from channelunit.mechanism_cache import build_paths
+from channelunit.mechanism_cache import cache_path
+from channelunit.mechanism_cache import compile_mechanisms
+from channelunit.mechanism_cache import is_compiled
+from channelunit.mechanism_cache import load_mechanisms
+from channelunit.mechanism_cache import mechanism_names
+from channelunit.mechanism_cache import mechanisms_hash
+
+channel_loc = os.path.join(data_path, "ion_channels")
+
+
+class TestMechanismCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.old_cache = os.environ.get("CHANNELUNIT_CACHE")
+        cls.cache = tempfile.mkdtemp()
+        os.environ["CHANNELUNIT_CACHE"] = cls.cache
+        cls.mods = tempfile.mkdtemp()
+        shutil.copy2(os.path.join(mechanisms_path, "svclmp2.mod"), cls.mods)
+        os.chmod(cls.mods, stat.S_IRUSR | stat.S_IXUSR)
+        cls.cwd = os.getcwd()
+        with ThreadPoolExecutor(3) as executor:
+            cls.build_dirs = list(executor.map(compile_mechanisms,
+                                               3*[cls.mods]))
+        cls.build_dir = cls.build_dirs[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.old_cache is None:
+            del os.environ["CHANNELUNIT_CACHE"]
+        else:
+            os.environ["CHANNELUNIT_CACHE"] = cls.old_cache
+        shutil.rmtree(cls.cache)
+        os.chmod(cls.mods, stat.S_IRWXU)
+        shutil.rmtree(cls.mods)
+
+    def test_cache_path(self):
+        self.assertEqual(cache_path(), self.cache)
+
+    def test_build_dir(self):
+        self.assertEqual(self.build_dir,
+                         os.path.join(self.cache, mechanisms_hash(self.mods)))
+
+    def test_compiled(self):
+        self.assertTrue(is_compiled(self.build_dir))
+
+    def test_sources_untouched(self):
+        self.assertEqual(["svclmp2.mod"], os.listdir(self.mods))
+
+    def test_concurrent_builds(self):
+        self.assertEqual(3*[self.build_dir], self.build_dirs)
+
+    def test_no_tmp_left(self):
+        self.assertEqual([os.path.basename(self.build_dir)],
+                         os.listdir(self.cache))
+
+    def test_cwd(self):
+        self.assertEqual(self.cwd, os.getcwd())
+
+    def test_no_rebuild(self):
+        mtime = os.path.getmtime(self.build_dir)
+        self.assertEqual(self.build_dir, compile_mechanisms(self.mods))
+        self.assertEqual(mtime, os.path.getmtime(self.build_dir))
+
+    def test_hash_same_sources(self):
+        self.assertEqual(mechanisms_hash(self.mods),
+                         mechanisms_hash(mechanisms_path))
+
+    def test_hash_changed_source(self):
+        path = tempfile.mkdtemp()
+        with open(os.path.join(self.mods, "svclmp2.mod")) as f:
+            text = f.read()
+        with open(os.path.join(path, "svclmp2.mod"), "w") as f:
+            f.write(text.replace("rs = 1 (megohm)", "rs = 2 (megohm)"))
+        self.assertNotEqual(mechanisms_hash(path),
+                            mechanisms_hash(self.mods))
+        shutil.rmtree(path)
+
+    def test_hash_compiler_flags(self):
+        old_hash = mechanisms_hash(self.mods)
+        old_flags = os.environ.get("CFLAGS")
+        os.environ["CFLAGS"] = "-O0"
+        new_hash = mechanisms_hash(self.mods)
+        if old_flags is None:
+            del os.environ["CFLAGS"]
+        else:
+            os.environ["CFLAGS"] = old_flags
+        self.assertNotEqual(old_hash, new_hash)
+
+    def test_hash_coreneuron(self):
+        old_hash = mechanisms_hash(self.mods)
+        os.environ["CHANNELUNIT_CORENEURON"] = "1"
+        try:
+            new_hash = mechanisms_hash(self.mods)
+            paths = build_paths(self.mods)
+        finally:
+            del os.environ["CHANNELUNIT_CORENEURON"]
+        self.assertNotEqual(old_hash, new_hash)
+        self.assertEqual([self.mods, CLAMP_PATH], paths)
+
+    def test_no_recompile(self):
+        path = tempfile.mkdtemp()
+        with open(os.path.join(path, "empty.mod"), "w") as f:
+            f.write("NEURON { SUFFIX empty }\n")
+        self.assertEqual(path, compile_mechanisms(path, recompile=False))
+        shutil.rmtree(path)
+
+
+class TestLoadMechanisms(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.build_dir = load_mechanisms(channel_loc)
+
+    def test_mechanism_names(self):
+        self.assertEqual(["SEClampOLS"], mechanism_names(mechanisms_path))
+
+    def test_mechanism_names_suffix(self):
+        names = mechanism_names(channel_loc)
+        self.assertIn("nap", names)
+        self.assertIn("CalHGHK", names)
+        self.assertEqual(len(names), len(os.listdir(channel_loc)))
+
+    def test_load_twice(self):
+        self.assertEqual(self.build_dir, load_mechanisms(channel_loc))
+
+    def test_load_same_sources(self):
+        path = tempfile.mkdtemp()
+        for fname in os.listdir(channel_loc):
+            shutil.copy2(os.path.join(channel_loc, fname), path)
+        self.assertEqual(self.build_dir, load_mechanisms(path))
+        shutil.rmtree(path)
+
+    def test_duplicate_suffix(self):
+        path = tempfile.mkdtemp()
+        shutil.copy2(os.path.join(channel_loc, "nap.mod"), path)
+        self.assertRaises(SystemExit, load_mechanisms, path)
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,6 +2,8 @@ import unittest
 import numpy as np
 
 from channelunit.base_classes import MembranePatch
+from channelunit.base_classes import LEGACY_SAMPLING_RATE
+from channelunit.base_classes import LEGACY_FILTER_CUTOFF
 
 
 class TestVclamp(unittest.TestCase):
@@ -187,6 +189,60 @@ class TestVclamp(unittest.TestCase):
                          self.modelljp2.vclamp.amp10+self.pulse)
 
 
+class TestSampling(unittest.TestCase):
+    def setUp(self):
+        self.model = MembranePatch(temp=22, Rm=20000, cm=1, v_rest=-65,
+                                   ljp=0, cvode=False, sim_dt=0.01)
+
+    def tearDown(self):
+        self.model.close()
+
+    def test_default(self):
+        self.assertEqual(0.05, self.model.dt)
+        self.assertFalse(self.model.legacy)
+
+    def test_legacy(self):
+        self.model.set_sampling(LEGACY_SAMPLING_RATE, LEGACY_FILTER_CUTOFF)
+        self.assertEqual(5e-5, self.model.dt)
+        self.assertTrue(self.model.legacy)
+
+    def test_filter_order(self):
+        self.assertEqual(9, len(self.model.f_b))
+        self.assertEqual(9, len(self.model.f_a))
+
+    def test_cutoff_too_high(self):
+        self.assertRaises(SystemExit, self.model.set_sampling, 20, 10)
+
+    def test_sos(self):
+        self.assertEqual((4, 6), self.model.sos.shape)
+
+    def test_design_cached(self):
+        other = MembranePatch(temp=22, Rm=20000, cm=1, v_rest=-65,
+                              ljp=0, cvode=False, sim_dt=0.01)
+        try:
+            self.assertIs(self.model.sos, other.sos)
+        finally:
+            other.close()
+
+    def test_10_kHz(self):
+        self.model.set_sampling(50, 10, 4)
+        self.assertEqual((2, 6), self.model.sos.shape)
+        self.assertEqual(0.02, self.model.dt)
+
+    def test_sampling(self):
+        with self.model.sampling(10, 2):
+            self.assertEqual(0.1, self.model.dt)
+            self.assertEqual(2, self.model.filter_cutoff)
+        self.assertEqual(0.05, self.model.dt)
+        self.assertEqual(5, self.model.filter_cutoff)
+
+    def test_sampling_order(self):
+        with self.model.sampling(order=4):
+            self.assertEqual(0.05, self.model.dt)
+            self.assertEqual((2, 6), self.model.sos.shape)
+        self.assertEqual((4, 6), self.model.sos.shape)
+
+
 
 
 if __name__ == "__main__":
@@ -1,9 +1,19 @@
 import os
+import shutil
+import tempfile
 import unittest
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
+from neuron import h
 
 from channelunit.base_classes import ModelPatch
+from channelunit.base_classes import LEGACY_SAMPLING_RATE
+from channelunit.base_classes import LEGACY_FILTER_CUTOFF
+from channelunit.base_classes import _waveform
+from channelunit import ModelWholeCellPatchCaSingleChan
 from channelunit import data_path
 
 loc = os.path.dirname(os.path.abspath(__file__))
@@ -370,6 +380,21 @@ class TestAddSingleChannel(unittest.TestCase):
         self.assertEqual([0.02],
                         self.out.patch.psection()["density_mechs"]["nap"]["gnabar"])
 
+    def test_add_channel_description(self):
+        self.assertIn("nap", self.out._describe()["density_mechs"])
+
+    def test_description_cached(self):
+        self.assertIs(self.out._describe(), self.out._describe())
+
+    def test_gbar_not_cached(self):
+        self.out.set_gbar("nap", 0.03)
+        self.assertEqual(0.03, self.out.get_gbar("nap"))
+        self.out.set_gbar("nap", 0.02)
+
+    def test_E_rev_from_segment(self):
+        self.assertEqual(self.out.patch.psection()["ions"]["na"]["ena"][0],
+                         self.out.calc_E_rev("na"))
+
 
 class TestCapabilites(unittest.TestCase):
     @classmethod
@@ -450,6 +475,1137 @@ class TestCapabilites(unittest.TestCase):
                          list(self.inactivationN_cc.keys()))
 
 
+class TestHoldingCheckpoint(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.levels = [-30, 0, 30]
+        cls.models = []
+        cls.traces = []
+        for cvode in [True, False]:
+            model = ModelPatch(channel_loc, ["kad"], ["k"],
+                               external_conc={"k": 2.5}, ljp=0, E_rev={},
+                               internal_conc={}, gbar_names={},
+                               gbar_values={}, temp=22, recompile=True,
+                               cvode=cvode, Rm=20000, v_rest=-65, cm=1,
+                               directory="validation_results", sim_dt=0.01)
+            cls.models.append(model)
+            cls.traces.append(model.get_activation_traces(cls.levels, -90, 5,
+                                                          save_traces=False))
+
+    def full_run(self, model, level):
+        with model.session():
+            current = model._record(model.vclamp._ref_i, model.dt)
+            stim_stop = model.set_vclamp(5, -90, 5, level, True)
+            h.finitialize(-90)
+            h.fcurrent()
+            h.frecord_init()
+            h.continuerun(stim_stop)
+            out = model.extract_current(current.as_numpy(), False, True, 5, 5,
+                                        model.dt, level)
+        beg = int(np.round(5/model.dt))
+        end = int(np.round(10/model.dt))
+        return out[beg:end]
+
+    def test_same_as_full_run_cvode(self):
+        for level in self.levels:
+            full = self.full_run(self.models[0], level)
+            self.assertTrue(np.array_equal(full, self.traces[0][level]))
+
+    def test_same_as_full_run_sim_dt(self):
+        for level in self.levels:
+            full = self.full_run(self.models[1], level)
+            self.assertTrue(np.array_equal(full, self.traces[1][level]))
+
+    def test_same_as_full_run_sampling(self):
+        # (model, sim_dt, sampling rate): steps longer than samples,
+        # samples on half steps, cvode models stepping by 0.025 ms
+        cases = [(1, 0.03, 50), (1, 0.01, 40), (1, 0.02, 100),
+                 (1, 0.005, 30), (0, None, 50), (0, None, 40)]
+        for i, sim_dt, rate in cases:
+            model = self.models[i]
+            if sim_dt is not None:
+                model.sim_dt = sim_dt
+            try:
+                with model.sampling(rate, 5):
+                    traces = model.get_activation_traces(
+                        self.levels, -90, 5, save_traces=False)
+                    for level in self.levels:
+                        full = self.full_run(model, level)
+                        self.assertTrue(np.array_equal(full, traces[level]),
+                                        (sim_dt, rate, level))
+            finally:
+                if sim_dt is not None:
+                    model.sim_dt = 0.01
+
+    def test_samples_long_holding(self):
+        # the checkpoint falls between two samples
+        model = self.models[1]
+        with model.session():
+            time = model._record(h._ref_t, model.dt)
+            stim_stop = model.set_vclamp(50, -90, 50, 10, False)
+            holding = model._checkpoint(-90, 50 - h.dt)
+            model._continuerun(holding, stim_stop)
+            branched = time.as_numpy().copy()
+            h.finitialize(-90)
+            h.fcurrent()
+            h.frecord_init()
+            h.continuerun(stim_stop)
+            full = time.as_numpy().copy()
+        self.assertEqual(len(full), len(branched))
+        self.assertTrue(np.allclose(full, branched, rtol=0, atol=1e-8))
+
+    def test_calcium_restored(self):
+        model = ModelWholeCellPatchCaSingleChan(channel_loc, "calHGHK", "ca",
+                                                1.5, -65)
+        with model.session():
+            node = model.ca[model.memb_shell].nodes[0]
+            stim_stop = model.set_vclamp(2, -90, 2, 10, True)
+            holding = model._checkpoint(-90, 2 - h.dt)
+            model._continuerun(holding, stim_stop)
+            first = node.concentration
+            model._continuerun(holding, stim_stop)
+            self.assertEqual(first, node.concentration)
+        model.close()
+
+
+
+class TestBatchedSweeps(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.levels = [-30, -10, 10, 30]
+        cls.model = ModelPatch(channel_loc, ["kad"], ["k"],
+                               external_conc={"k": 2.5}, ljp=0, E_rev={},
+                               internal_conc={}, gbar_names={},
+                               gbar_values={}, temp=22, recompile=True,
+                               cvode=False, Rm=20000, v_rest=-65, cm=1,
+                               directory="validation_results", sim_dt=0.01)
+
+    def batched(self, method, *args):
+        self.model.batched = True
+        try:
+            return getattr(self.model, method)(*args, save_traces=False)
+        finally:
+            self.model.batched = False
+
+    def assert_same(self, serial, batched):
+        self.assertEqual(list(serial.keys()), list(batched.keys()))
+        for level in serial:
+            self.assertTrue(np.array_equal(serial[level], batched[level]))
+
+    def test_activation_SS(self):
+        args = (self.levels, -90, 5, 1, None, False, True)
+        serial = self.model.get_activation_SS(*args, save_traces=False)
+        self.assert_same(serial, self.batched("get_activation_SS", *args))
+
+    def test_inactivation_SS(self):
+        args = (self.levels, 10, 5, 1, None)
+        serial = self.model.get_inactivation_SS(*args, save_traces=False)
+        self.assert_same(serial, self.batched("get_inactivation_SS", *args))
+
+    def test_activation_traces(self):
+        args = (self.levels, -90, 5)
+        serial = self.model.get_activation_traces(*args, save_traces=False)
+        self.assert_same(serial,
+                         self.batched("get_activation_traces", *args))
+
+    def test_clones_deleted(self):
+        n_secs = len(list(h.allsec()))
+        self.batched("get_activation_traces", self.levels, -90, 2)
+        self.assertEqual(n_secs, len(list(h.allsec())))
+
+    def test_clone(self):
+        self.model.set_gbar("kad", 0.004)
+        patch, vclamp = self.model._clone()
+        self.assertEqual(0.004, patch(0.5).kad.gbar)
+        self.assertEqual(self.model.patch.g_pas, patch.g_pas)
+        self.assertEqual(self.model.patch.ek, patch.ek)
+        h.delete_section(sec=patch)
+        self.model.set_gbar("kad", 0.001)
+
+
+class TestPassiveLeak(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.levels = [-30, -10, 10, 30]
+        cls.model = ModelPatch(channel_loc, ["kad"], ["k"],
+                               external_conc={"k": 2.5}, ljp=0, E_rev={},
+                               internal_conc={}, gbar_names={},
+                               gbar_values={}, temp=22, recompile=True,
+                               cvode=False, Rm=20000, v_rest=-65, cm=1,
+                               directory="validation_results", sim_dt=0.01)
+        cls.pn = cls.model.get_activation_traces(cls.levels, -90, 5,
+                                                 save_traces=False)
+        cls.model.leak = "passive"
+        cls.passive = cls.model.get_activation_traces(cls.levels, -90, 5,
+                                                      save_traces=False)
+        cls.model.leak = "pn"
+
+    def test_same_as_pn(self):
+        # the baseline of the first P/N pulse starts with the transient
+        # of the step to v_sub, spread by the filter over the first ms
+        skip = int(np.round(1/self.model.dt))
+        for level in self.levels:
+            self.assertTrue(np.allclose(self.pn[level][skip:],
+                                        self.passive[level][skip:],
+                                        rtol=1e-3, atol=1e-6))
+
+    def test_batched(self):
+        self.model.leak = "passive"
+        self.model.batched = True
+        try:
+            batched = self.model.get_activation_traces(self.levels, -90, 5,
+                                                       save_traces=False)
+        finally:
+            self.model.leak = "pn"
+            self.model.batched = False
+        for level in self.levels:
+            self.assertTrue(np.array_equal(self.passive[level],
+                                           batched[level]))
+
+    def test_no_pn_pulses(self):
+        self.model.leak = "passive"
+        try:
+            self.assertEqual(10 + self.model.dt,
+                             self.model.set_vclamp(5, -90, 5, 10, True))
+            self.assertEqual(0, self.model.vclamp.dur3)
+        finally:
+            self.model.leak = "pn"
+
+    def test_template_cached(self):
+        template = self.model._leak_template(5, 5, self.model.dt)
+        self.assertIs(template,
+                      self.model._leak_template(5, 5, self.model.dt))
+        self.model.Rm = 10000
+        try:
+            self.assertIsNot(template,
+                             self.model._leak_template(5, 5, self.model.dt))
+        finally:
+            self.model.Rm = 20000
+
+    def test_template_sections_deleted(self):
+        n_secs = len(list(h.allsec()))
+        self.model._leak_template(5, 3, self.model.dt)
+        self.assertEqual(n_secs, len(list(h.allsec())))
+
+    def test_no_step(self):
+        self.model.leak = "passive"
+        try:
+            I = np.zeros(int(10/self.model.dt) + 1)
+            self.assertRaises(SystemExit, self.model.extract_current,
+                              I, False, True, 5, 5, self.model.dt)
+        finally:
+            self.model.leak = "pn"
+
+    def test_unknown(self):
+        for leak in ["Passive", "none", None]:
+            self.model.leak = leak
+            try:
+                self.assertRaises(SystemExit,
+                                  self.model.get_activation_traces,
+                                  [-30], -90, 5, save_traces=False)
+                self.assertRaises(SystemExit,
+                                  self.model.get_inactivation_traces,
+                                  [-90], -30, 5, False, True,
+                                  save_traces=False)
+            finally:
+                self.model.leak = "pn"
+
+
+class TestCachedPN(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.levels = [-30, -10, 10, 30]
+        cls.model = ModelPatch(channel_loc, ["kad"], ["k"],
+                               external_conc={"k": 2.5}, ljp=0, E_rev={},
+                               internal_conc={}, gbar_names={},
+                               gbar_values={}, temp=22, recompile=True,
+                               cvode=False, Rm=20000, v_rest=-65, cm=1,
+                               directory="validation_results", sim_dt=0.01)
+        cls.pn = cls.model.get_activation_traces(cls.levels, -90, 5,
+                                                 save_traces=False)
+        cls.model.leak = "cached"
+        cls.first = cls.model.get_activation_traces(cls.levels, -90, 5,
+                                                    save_traces=False)
+        cls.cached = cls.model.get_activation_traces(cls.levels, -90, 5,
+                                                     save_traces=False)
+
+    def traces(self, leak, levels):
+        self.model.leak = leak
+        try:
+            return self.model.get_activation_traces(levels, -90, 5,
+                                                    save_traces=False)
+        finally:
+            self.model.leak = "cached"
+
+    def test_first_sweep(self):
+        for level in self.levels:
+            self.assertTrue(np.array_equal(self.pn[level],
+                                           self.first[level]))
+
+    def test_cached_sweep(self):
+        for level in self.levels:
+            self.assertTrue(np.array_equal(self.pn[level],
+                                           self.cached[level]))
+
+    def test_no_pn_pulses(self):
+        self.assertEqual(10 + self.model.dt,
+                         self.model.set_vclamp(5, -90, 5, 10, True))
+        self.assertEqual(60, self.model.set_vclamp(5, -90, 5, 11, True))
+
+    def test_new_level(self):
+        out = self.traces("cached", [-50] + self.levels)
+        pn = self.traces("pn", [-50])
+        self.assertTrue(np.array_equal(pn[-50], out[-50]))
+        for level in self.levels:
+            self.assertTrue(np.array_equal(self.pn[level], out[level]))
+
+    def test_batched(self):
+        self.model.batched = True
+        try:
+            out = self.traces("cached", [-40] + self.levels)
+        finally:
+            self.model.batched = False
+        for level in self.levels:
+            self.assertTrue(np.array_equal(self.pn[level], out[level]))
+
+    def test_gbar_changed(self):
+        # the pulses are kept when channel parameters change
+        self.model.set_gbar("kad", 0.01)
+        try:
+            pn = self.traces("pn", self.levels)
+            cached = self.traces("cached", self.levels)
+        finally:
+            self.model.set_gbar("kad", 0.001)
+        for level in self.levels:
+            self.assertTrue(np.allclose(pn[level], cached[level],
+                                        rtol=1e-3, atol=1e-5))
+
+    def test_passive_changed(self):
+        key = self.model._pn_key(-90, 10, 5, 5, self.model.dt)
+        self.model.Rm = 10000
+        try:
+            self.assertNotEqual(key, self.model._pn_key(-90, 10, 5, 5,
+                                                        self.model.dt))
+        finally:
+            self.model.Rm = 20000
+
+
+class TestTwoPulse(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # na3 inactivation reaches the steady state during the 100 ms step
+        cls.levels = [-90, -30, -10]
+        cls.model = ModelPatch(channel_loc, ["na3"], ["na"],
+                               external_conc={"na": 110}, ljp=0, E_rev={},
+                               internal_conc={}, gbar_names={},
+                               gbar_values={}, temp=22, recompile=True,
+                               cvode=False, Rm=20000, v_rest=-65, cm=1,
+                               directory="validation_results", sim_dt=0.01)
+        cls.model.leak = "passive"
+        cls.act, cls.inact = cls.model.get_two_pulse_traces(
+            cls.levels, -90, 100, -5, 10, electrode_current=False,
+            save_traces=False)
+
+    def test_activation(self):
+        out = self.model.get_activation_traces(self.levels, -90, 100,
+                                               False, False,
+                                               save_traces=False)
+        for level in self.levels:
+            self.assertTrue(np.array_equal(out[level], self.act[level]))
+
+    def test_inactivation(self):
+        out = self.model.get_inactivation_SS(self.levels, -5, 10, 1, None,
+                                             False, False,
+                                             save_traces=False)
+        two_pulse = self.model._steady_state(self.inact, 1, None, "to_one")
+        for level in self.levels:
+            self.assertAlmostEqual(out[level], two_pulse[level], delta=1e-3)
+
+    def test_inactivation_window(self):
+        self.assertEqual(int(np.round(20/self.model.dt)),
+                         len(self.inact[-90]))
+
+    def test_batched(self):
+        self.model.batched = True
+        try:
+            act, inact = self.model.get_two_pulse_traces(
+                self.levels, -90, 100, -5, 10, electrode_current=False,
+                save_traces=False)
+        finally:
+            self.model.batched = False
+        for level in self.levels:
+            self.assertTrue(np.allclose(self.act[level], act[level],
+                                        rtol=1e-4, atol=1e-6))
+            self.assertTrue(np.allclose(self.inact[level], inact[level],
+                                        rtol=1e-4, atol=1e-6))
+
+    def test_pn_leak_subtraction(self):
+        self.model.leak = "pn"
+        try:
+            self.assertRaises(SystemExit, self.model.set_two_pulse_vclamp,
+                              5, -90, 5, 10, 5, -5, True)
+        finally:
+            self.model.leak = "passive"
+
+    def test_no_common_levels(self):
+        act, inact = self.model.get_two_pulse_SS([-30], [-10], -90, 10, -5,
+                                                 5, 1, None, False, 1, None,
+                                                 False, False,
+                                                 save_traces=False)
+        self.assertEqual(([-30], [-10]), (list(act), list(inact)))
+
+    def test_pn_two_pulse_SS(self):
+        self.model.leak = "pn"
+        try:
+            self.assertRaises(SystemExit, self.model.get_two_pulse_SS,
+                              [-30], [-30], -90, 10, -5, 5, 1, None, False,
+                              1, None, False, True, save_traces=False)
+        finally:
+            self.model.leak = "passive"
+
+    def test_steady_state_curves(self):
+        # conditioning for 200 ms from -90 mV instead of the steady
+        # state, inactivation differed by 5e-5 (ionic currents) and
+        # 1.6e-3 (electrode currents, see get_two_pulse_traces)
+        levels = [-90, -70, -50, -30, -10, 10]
+        for electrode_current, delta in [(False, 1e-4), (True, 2e-3)]:
+            act, inact = self.model.get_two_pulse_SS(
+                levels, levels, -90, 200, -5, 10, 1, None, False, 1, None,
+                False, electrode_current, save_traces=False)
+            act_separate = self.model.get_activation_SS(
+                levels, -90, 200, 1, None, False, electrode_current,
+                save_traces=False)
+            inact_separate = self.model.get_inactivation_SS(
+                levels, -5, 10, 1, None, False, electrode_current,
+                save_traces=False)
+            self.assertEqual(act_separate, act)
+            for level in levels:
+                self.assertAlmostEqual(inact_separate[level], inact[level],
+                                       delta=delta)
+
+
+class TestConcatenated(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.levels = [-50, -10, 30]
+        cls.model = ModelPatch(channel_loc, ["kad"], ["k"],
+                               external_conc={"k": 2.5}, ljp=0, E_rev={},
+                               internal_conc={}, gbar_names={},
+                               gbar_values={}, temp=22, recompile=True,
+                               cvode=False, Rm=20000, v_rest=-65, cm=1,
+                               directory="validation_results", sim_dt=0.01)
+        cls.serial = cls.model.get_activation_traces(cls.levels, -90, 5,
+                                                     save_traces=False)
+        # kad inactivation settles within 300 ms
+        cls.model.concatenated = True
+        cls.model.recovery = 300
+        cls.out = cls.model.get_activation_traces(cls.levels, -90, 5,
+                                                  save_traces=False)
+
+    def traces(self, method, *args):
+        self.model.concatenated = False
+        try:
+            serial = getattr(self.model, method)(self.levels, *args,
+                                                 save_traces=False)
+        finally:
+            self.model.concatenated = True
+        return serial, getattr(self.model, method)(self.levels, *args,
+                                                   save_traces=False)
+
+    def test_activation(self):
+        # without the filtered P/N artifact of the first ms
+        beg = int(np.round(1/self.model.dt))
+        for level in self.levels:
+            self.assertEqual(self.serial[level].shape,
+                             self.out[level].shape)
+            self.assertTrue(np.allclose(self.serial[level][beg:],
+                                        self.out[level][beg:],
+                                        rtol=1e-3, atol=1e-6))
+
+    def test_channel_current(self):
+        serial, out = self.traces("get_activation_traces", -90, 5, False,
+                                  False)
+        for level in self.levels:
+            self.assertTrue(np.allclose(serial[level], out[level],
+                                        rtol=1e-3, atol=1e-6))
+
+    def test_inactivation(self):
+        serial, out = self.traces("get_inactivation_traces", -5, 5, False,
+                                  False)
+        for level in self.levels:
+            self.assertEqual(serial[level].shape, out[level].shape)
+            self.assertTrue(np.allclose(serial[level], out[level],
+                                        rtol=1e-3, atol=1e-6))
+
+    def test_no_recovery(self):
+        # the second step of [30, 30] starts right after the first one
+        recovered = self.model.get_activation_traces([30, 30], -90, 5,
+                                                     False, False,
+                                                     save_traces=False)
+        self.model.recovery = 0
+        try:
+            out = self.model.get_activation_traces([30, 30], -90, 5, False,
+                                                   False, save_traces=False)
+        finally:
+            self.model.recovery = 300
+        self.assertFalse(np.allclose(recovered[30], out[30], rtol=1e-3,
+                                     atol=1e-6))
+
+
+class TestEarlyStop(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.levels = [-50, -10, 30]
+        cls.model = ModelPatch(channel_loc, ["kad"], ["k"],
+                               external_conc={"k": 2.5}, ljp=0, E_rev={},
+                               internal_conc={}, gbar_names={},
+                               gbar_values={}, temp=22, recompile=True,
+                               cvode=False, Rm=20000, v_rest=-65, cm=1,
+                               directory="validation_results", sim_dt=0.01)
+        cls.model.leak = "passive"
+
+    def steady_state(self, method, early_stop, *args):
+        self.model.early_stop = early_stop
+        try:
+            return getattr(self.model, method)(self.levels, *args,
+                                               save_traces=False)
+        finally:
+            self.model.early_stop = False
+
+    def test_activation_t_mes(self):
+        args = (-90, 50, 1, 5, False, True)
+        self.assertEqual(self.steady_state("get_activation_SS", False,
+                                           *args),
+                         self.steady_state("get_activation_SS", True,
+                                           *args))
+
+    def test_inactivation_t_mes(self):
+        args = (-5, 20, 1, 22, False, False)
+        self.assertEqual(self.steady_state("get_inactivation_SS", False,
+                                           *args),
+                         self.steady_state("get_inactivation_SS", True,
+                                           *args))
+
+    def test_peak(self):
+        args = (-90, 50, 1, None, False, True)
+        full = self.steady_state("get_activation_SS", False, *args)
+        out = self.steady_state("get_activation_SS", True, *args)
+        for level in self.levels:
+            self.assertAlmostEqual(full[level], out[level], delta=1e-3)
+
+    def test_t_mes_stop(self):
+        self.model.early_stop = True
+        try:
+            with self.model._measuring(5):
+                out = self.model._watch(10, 10, 20, 15, 10, True, None,
+                                        None)
+        finally:
+            self.model.early_stop = False
+        self.assertAlmostEqual(15 + self.model.sim_dt, out)
+
+    def test_pn_pulses(self):
+        self.model.early_stop = True
+        self.model.leak = "pn"
+        try:
+            with self.model._measuring(5):
+                out = self.model._watch(10, 10, 60, 15, 10, True, None,
+                                        None)
+        finally:
+            self.model.early_stop = False
+            self.model.leak = "passive"
+        self.assertEqual(60, out)
+
+    def test_traces(self):
+        # only steady-state sweeps stop early
+        self.model.early_stop = True
+        try:
+            out = self.model.get_activation_traces(self.levels, -90, 5,
+                                                   save_traces=False)
+        finally:
+            self.model.early_stop = False
+        full = self.model.get_activation_traces(self.levels, -90, 5,
+                                                save_traces=False)
+        for level in self.levels:
+            self.assertTrue(np.array_equal(full[level], out[level]))
+
+
+class TestWaveform(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.levels = [-50, 10]
+        cls.model = ModelPatch(channel_loc, ["kad"], ["k"],
+                               external_conc={"k": 2.5}, ljp=0, E_rev={},
+                               internal_conc={}, gbar_names={},
+                               gbar_values={}, temp=22, recompile=True,
+                               cvode=False, Rm=20000, v_rest=-65, cm=1,
+                               directory="validation_results", sim_dt=0.01)
+
+    def test_compile(self):
+        times, values, discontinuities = _waveform([(1, 0, 0), (2, 0, 5),
+                                                    (1, -3, -3)])
+        self.assertEqual([0, 1, 1, 3, 3, 4], times.tolist())
+        self.assertEqual([0, 0, 0, 5, -3, -3], values.tolist())
+        self.assertEqual([1, 3], discontinuities.tolist())
+
+    def test_steps(self):
+        steps = self.model.get_activation_traces(self.levels, -90, 5, False,
+                                                 False, save_traces=False)
+        out = self.model.get_waveform_traces(self.levels,
+                                             [(5, -90, -90),
+                                              (5, None, None)],
+                                             save_traces=False)
+        beg = int(np.round(5/self.model.dt))
+        # the filter runs over records of different lengths
+        for level in self.levels:
+            self.assertTrue(np.allclose(
+                steps[level], out[level][beg: beg + len(steps[level])],
+                rtol=1e-9, atol=1e-12))
+
+    def test_many_segments(self):
+        segments = [(0.5, -90 + 5*(i % 2), -90 + 5*(i % 2))
+                    for i in range(30)]
+        out = self.model.get_waveform_traces([-90], segments,
+                                             save_traces=False)
+        self.assertEqual(int(np.round(15/self.model.dt)) + 1, len(out[-90]))
+
+    def test_reuse(self):
+        self.model.set_waveform([(5, -90, -90), (10, -90, 10)])
+        played = self.model._waveform
+        self.model.set_waveform([(5, -80, -80), (10, -80, 20)])
+        try:
+            self.assertIs(played, self.model._waveform)
+            self.assertEqual([-80, -80, -80, 20],
+                             played[1].as_numpy().tolist())
+        finally:
+            self.model._stop_waveform()
+
+    def test_new_durations(self):
+        self.model.set_waveform([(5, -90, -90), (10, -90, 10)])
+        played = self.model._waveform
+        self.model.set_waveform([(5, -90, -90), (20, -90, 10)])
+        try:
+            self.assertIsNot(played, self.model._waveform)
+        finally:
+            self.model._stop_waveform()
+
+    def test_set_vclamp(self):
+        self.model.set_waveform([(5, -90, -90), (10, -90, 10)])
+        self.model.set_vclamp(5, -90, 5, 10, False)
+        self.assertIsNone(self.model._waveform)
+
+
+def threaded_traces(levels, threads):
+    model = ModelPatch(channel_loc, ["nap"], ["na"],
+                       external_conc={"na": 110}, ljp=0, E_rev={},
+                       internal_conc={}, gbar_names={"nap": "gnabar"},
+                       gbar_values={}, temp=22, recompile=True,
+                       cvode=False, Rm=20000, v_rest=-65, cm=1,
+                       directory="validation_results", sim_dt=0.01)
+    model.batched = True
+    model.threads = threads
+    out = model.get_activation_traces(levels, -90, 5, save_traces=False)
+    return out, h.ParallelContext().nthread()
+
+
+class TestThreads(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.levels = [-30, -10, 10, 30]
+        # rxd of the calcium models of other tests forbids threads
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            cls.serial, _ = pool.submit(threaded_traces, cls.levels,
+                                        1).result()
+            cls.threaded, cls.nthread = pool.submit(threaded_traces,
+                                                    cls.levels, 2).result()
+
+    def test_same_as_one_thread(self):
+        self.assertEqual(list(self.serial.keys()),
+                         list(self.threaded.keys()))
+        for level in self.levels:
+            self.assertTrue(np.array_equal(self.serial[level],
+                                           self.threaded[level]))
+
+    def test_nthread_restored(self):
+        self.assertEqual(1, self.nthread)
+
+    def test_not_thread_safe(self):
+        model = ModelPatch(channel_loc, ["kad"], ["k"],
+                           external_conc={"k": 2.5}, ljp=0, E_rev={},
+                           internal_conc={}, gbar_names={},
+                           gbar_values={}, temp=22, recompile=True,
+                           cvode=False, Rm=20000, v_rest=-65, cm=1,
+                           directory="validation_results", sim_dt=0.01)
+        model.batched = True
+        model.threads = 2
+        self.assertRaises(SystemExit, model.get_activation_traces,
+                          self.levels, -90, 5, save_traces=False)
+        model.close()
+
+    def test_rxd(self):
+        model = ModelWholeCellPatchCaSingleChan(channel_loc, "calHGHK", "ca",
+                                                1.5, -65)
+        model.close()
+        model = ModelPatch(channel_loc, ["nap"], ["na"],
+                           external_conc={"na": 110}, ljp=0, E_rev={},
+                           internal_conc={}, gbar_names={"nap": "gnabar"},
+                           gbar_values={}, temp=22, recompile=True,
+                           cvode=False, Rm=20000, v_rest=-65, cm=1,
+                           directory="validation_results", sim_dt=0.01)
+        model.batched = True
+        model.threads = 2
+        self.assertRaises(SystemExit, model.get_activation_traces,
+                          self.levels, -90, 5, save_traces=False)
+        model.close()
+
+
+def coreneuron_traces(mod_path, levels):
+    model = ModelPatch(mod_path, ["nap"], ["na"],
+                       external_conc={"na": 110}, ljp=0, E_rev={},
+                       internal_conc={}, gbar_names={"nap": "gnabar"},
+                       gbar_values={}, temp=22, recompile=True,
+                       cvode=False, Rm=20000, v_rest=-65, cm=1,
+                       directory="validation_results", sim_dt=0.01)
+    model.batched = True
+    out = []
+    for backend in ["neuron", "coreneuron"]:
+        model.backend = backend
+        out.append(model.get_activation_traces(levels, -90, 5,
+                                               save_traces=False))
+    return out
+
+
+class TestCoreNEURON(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.levels = [-30, -10, 10, 30]
+        cls.mods = tempfile.mkdtemp()
+        shutil.copy2(os.path.join(channel_loc, "nap.mod"), cls.mods)
+        # mechanisms of this process are not built for CoreNEURON
+        os.environ["CHANNELUNIT_CORENEURON"] = "1"
+        try:
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                cls.neuron, cls.coreneuron = pool.submit(
+                    coreneuron_traces, cls.mods, cls.levels).result()
+        finally:
+            del os.environ["CHANNELUNIT_CORENEURON"]
+            shutil.rmtree(cls.mods)
+
+    def test_same_as_neuron(self):
+        self.assertEqual(list(self.neuron.keys()),
+                         list(self.coreneuron.keys()))
+        for level in self.levels:
+            self.assertTrue(np.array_equal(self.neuron[level],
+                                           self.coreneuron[level]))
+
+    def test_not_built(self):
+        model = ModelPatch(channel_loc, ["nap"], ["na"],
+                           external_conc={"na": 110}, ljp=0, E_rev={},
+                           internal_conc={}, gbar_names={"nap": "gnabar"},
+                           gbar_values={}, temp=22, recompile=True,
+                           cvode=False, Rm=20000, v_rest=-65, cm=1,
+                           directory="validation_results", sim_dt=0.01)
+        model.batched = True
+        model.backend = "coreneuron"
+        self.assertRaises(SystemExit, model.get_activation_traces,
+                          self.levels, -90, 5, save_traces=False)
+        model.backend = "gpu"
+        self.assertRaises(SystemExit, model.get_activation_traces,
+                          self.levels, -90, 5, save_traces=False)
+        model.close()
+
+
+class TestExtractCurrents(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.levels = [-50, -10, 30]
+        cls.model = ModelPatch(channel_loc, ["kad"], ["k"],
+                               external_conc={"k": 2.5}, ljp=0,
+                               E_rev={"k": -90}, internal_conc={},
+                               gbar_names={}, gbar_values={}, temp=22,
+                               recompile=True, cvode=False, Rm=20000,
+                               v_rest=-65, cm=1,
+                               directory="validation_results", sim_dt=0.01)
+        # holding, step and the P/N pulses of 5 ms steps
+        size = int(np.round(60/cls.model.dt))
+        cls.I = np.random.default_rng(0).normal(size=(len(cls.levels),
+                                                      size))
+
+    def assert_rows(self, chord, filtering, **kwargs):
+        steps = [level + 90 for level in self.levels]
+        out = self.model.extract_currents(self.I, chord, True, 5, 5,
+                                          self.model.dt, self.levels,
+                                          filtering, steps, -90)
+        for row, I, level, step in zip(out, self.I, self.levels, steps):
+            self.assertTrue(np.array_equal(
+                self.model.extract_current(I, chord, True, 5, 5,
+                                           self.model.dt, level, filtering,
+                                           step, -90), row))
+
+    def test_pn(self):
+        self.assert_rows(False, True)
+
+    def test_chord_conductance(self):
+        self.assert_rows(True, False)
+
+    def test_passive(self):
+        self.model.leak = "passive"
+        try:
+            self.assert_rows(True, True)
+        finally:
+            self.model.leak = "pn"
+
+    def test_cached(self):
+        self.model.leak = "cached"
+        try:
+            self.assert_rows(False, True)
+        finally:
+            self.model.leak = "pn"
+            self.model._pn_templates.clear()
+
+    def assert_read(self, chord, filtering):
+        steps = [level + 90 for level in self.levels]
+        full = self.model.extract_currents(self.I, chord, True, 5, 5,
+                                           self.model.dt, self.levels,
+                                           filtering, steps, -90)
+        out = self.model.extract_currents(self.I, chord, True, 5, 5,
+                                          self.model.dt, self.levels,
+                                          filtering, steps, -90, t_read=10)
+        size = int(np.round(10/self.model.dt))
+        self.assertLessEqual(out.shape[1], full.shape[1])
+        self.assertTrue(np.array_equal(full[:, :size], out[:, :size]))
+        return out
+
+    def test_t_read_pn(self):
+        # the P/N pulses are in the trace
+        out = self.assert_read(False, True)
+        self.assertEqual(self.I.shape, out.shape)
+
+    def test_t_read_passive(self):
+        self.model.leak = "passive"
+        try:
+            out = self.assert_read(True, True)
+        finally:
+            self.model.leak = "pn"
+        self.assertEqual(int(np.round(10/self.model.dt)), out.shape[1])
+
+    def test_t_read_cached(self):
+        self.model.leak = "cached"
+        try:
+            out = self.assert_read(False, True)
+        finally:
+            self.model.leak = "pn"
+            self.model._pn_templates.clear()
+        self.assertEqual(int(np.round(10/self.model.dt)), out.shape[1])
+
+    def test_leak_amp(self):
+        dt = self.model.dt
+        out = ModelPatch.curr_leak_amp(self.I, 5, 5, dt)
+        for row, I in zip(out, self.I):
+            expected = np.zeros(int(np.round(5/dt)))
+            t_start = 15
+            for i in range(4):
+                basal = I[int(np.round(t_start/dt)):
+                          int(np.round((t_start + 5)/dt))]
+                expected += (I[int(np.round((t_start + 5)/dt)):
+                               int(np.round((t_start + 10)/dt))] - basal)
+                t_start += 10
+            self.assertTrue(np.array_equal(expected, row))
+
+
+class TestBuffers(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.levels = [-50, -10, 30]
+        cls.model = ModelPatch(channel_loc, ["kad"], ["k"],
+                               external_conc={"k": 2.5}, ljp=0, E_rev={},
+                               internal_conc={}, gbar_names={},
+                               gbar_values={}, temp=22, recompile=True,
+                               cvode=False, Rm=20000, v_rest=-65, cm=1,
+                               directory="validation_results", sim_dt=0.01)
+        cls.act = cls.model.get_activation_traces(cls.levels, -90, 5,
+                                                  save_traces=False)
+
+    def test_recorders_reused(self):
+        self.model.get_activation_traces(self.levels, -90, 5,
+                                         save_traces=False)
+        idle = list(self.model._idle_recorders)
+        self.assertTrue(idle)
+        self.model.get_activation_traces(self.levels, -90, 5,
+                                         save_traces=False)
+        self.assertEqual(sorted(map(id, idle)),
+                         sorted(map(id, self.model._idle_recorders)))
+
+    def test_out(self):
+        out = np.zeros((len(self.levels), int(np.round(5/self.model.dt))))
+        traces = self.model.get_activation_traces(self.levels, -90, 5,
+                                                  save_traces=False, out=out)
+        for row, level in zip(out, self.levels):
+            self.assertTrue(np.array_equal(self.act[level], row))
+            self.assertIs(out, traces[level].base)
+
+    def test_out_inactivation(self):
+        out = np.zeros((len(self.levels), int(np.round(10/self.model.dt))))
+        traces = self.model.get_inactivation_traces(self.levels, -5, 5,
+                                                    False, False,
+                                                    save_traces=False,
+                                                    out=out)
+        self.assertTrue(all(val.base is out for val in traces.values()))
+
+    def test_out_shape(self):
+        out = np.zeros((len(self.levels), 3))
+        self.assertRaises(SystemExit, self.model.get_activation_traces,
+                          self.levels, -90, 5, save_traces=False, out=out)
+
+    def test_out_batched(self):
+        out = np.zeros((len(self.levels), int(np.round(5/self.model.dt))))
+        self.model.batched = True
+        try:
+            self.model.get_activation_traces(self.levels, -90, 5,
+                                             save_traces=False, out=out)
+        finally:
+            self.model.batched = False
+        for row, level in zip(out, self.levels):
+            self.assertTrue(np.allclose(self.act[level], row,
+                                        rtol=1e-3, atol=1e-6))
+
+    def test_steady_state_buffer(self):
+        args = (self.levels, -90, 5, 1, None, False, True)
+        first = self.model.get_activation_SS(*args, save_traces=False)
+        buffer = self.model._buffers["_activation_sweep"]
+        second = self.model.get_activation_SS(*args, save_traces=False)
+        self.assertIs(buffer, self.model._buffers["_activation_sweep"])
+        self.assertEqual(first, second)
+
+    def test_two_pulse_fallback(self):
+        # no common levels, the activation traces are kept while
+        # the (shorter) inactivation ones are simulated
+        act, inact = self.model.get_two_pulse_SS(
+            self.levels, [-90, -70], -90, 5, -5, 2, 1, None, False,
+            1, None, False, True, save_traces=False)
+        self.assertEqual(act, self.model.get_activation_SS(
+            self.levels, -90, 5, 1, None, False, True, save_traces=False))
+
+
+class TestFloat32(unittest.TestCase):
+    # demo_CA1 channels: name, ion, external concentration, gbar name
+    channels = [("kad", "k", 2.5, "gbar"), ("na3", "na", 110, "gbar"),
+                ("nap", "na", 110, "gnabar")]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.levels = [-50, -10, 30]
+        cls.models = [ModelPatch(channel_loc, [name], [ion],
+                                 external_conc={ion: conc}, ljp=0,
+                                 E_rev={}, internal_conc={},
+                                 gbar_names={name: gbar}, gbar_values={},
+                                 temp=22, recompile=True, cvode=False,
+                                 Rm=20000, v_rest=-65, cm=1,
+                                 directory="validation_results",
+                                 sim_dt=0.01)
+                      for name, ion, conc, gbar in cls.channels]
+
+    def traces(self, model, method, *args):
+        double = getattr(model, method)(self.levels, *args,
+                                        save_traces=False)
+        model.dtype = "float32"
+        try:
+            single = getattr(model, method)(self.levels, *args,
+                                            save_traces=False)
+        finally:
+            model.dtype = "float64"
+        return double, single
+
+    def assert_rounded(self, double, single):
+        # every sample is rounded once
+        for level in self.levels:
+            self.assertEqual(np.float32, single[level].dtype)
+            self.assertTrue(np.all(np.abs(single[level] - double[level])
+                                   <= 2**-24*np.abs(double[level])))
+
+    def test_activation(self):
+        for model in self.models:
+            self.assert_rounded(*self.traces(model, "get_activation_traces",
+                                             -90, 5))
+
+    def test_inactivation(self):
+        for model in self.models:
+            self.assert_rounded(*self.traces(model,
+                                             "get_inactivation_traces",
+                                             -5, 5, True, True))
+
+    def test_steady_state(self):
+        for model in self.models:
+            double, single = self.traces(model, "get_activation_SS", -90, 5,
+                                         1, None, False, True)
+            for level in self.levels:
+                self.assertTrue(np.isclose(double[level], single[level],
+                                           rtol=2**-22, atol=0))
+
+    def test_saved(self):
+        model = self.models[0]
+        time = np.arange(100)*model.dt
+        values = {0: np.float32(np.sin(time))}
+        sizes = []
+        for dtype in ["float64", "float32"]:
+            model.dtype = dtype
+            model._save_csv("Float32_" + dtype, time, values)
+            fname = os.path.join(model.base_directory, "data",
+                                 "Float32_%s.csv" % dtype)
+            sizes.append(os.path.getsize(fname))
+            saved = np.loadtxt(fname, delimiter=";", skiprows=1)
+            self.assertTrue(np.array_equal(values[0],
+                                           saved[1].astype(np.float32)))
+        model.dtype = "float64"
+        self.assertLess(sizes[1], 0.7*sizes[0])
+
+    def test_unknown(self):
+        model = self.models[0]
+        model.dtype = "float16"
+        try:
+            self.assertRaises(SystemExit, model.get_activation_traces,
+                              self.levels, -90, 5, save_traces=False)
+        finally:
+            model.dtype = "float64"
+
+
+class TestSweepMemory(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.levels = list(range(-60, 40, 10))
+        cls.model = ModelPatch(channel_loc, ["kad"], ["k"],
+                               external_conc={"k": 2.5}, ljp=0, E_rev={},
+                               internal_conc={}, gbar_names={},
+                               gbar_values={}, temp=22, recompile=True,
+                               cvode=False, Rm=20000, v_rest=-65, cm=1,
+                               directory="validation_results", sim_dt=0.01)
+        # a run with the P/N pulses
+        t_stop = cls.model.set_vclamp(50, -90, 50, 0, True)
+        cls.run_bytes = 8*int(t_stop/cls.model.dt)
+
+    def peak(self, method, *args):
+        # mechanisms and templates are ready before tracing
+        getattr(self.model, method)(self.levels[:1], *args,
+                                    save_traces=False)
+        tracemalloc.start()
+        try:
+            out = getattr(self.model, method)(self.levels, *args,
+                                              save_traces=False)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return out, peak
+
+    def test_activation_windows(self):
+        out, peak = self.peak("get_activation_traces", -90, 50)
+        values = list(out.values())
+        self.assertEqual(int(np.round(50/self.model.dt)), len(values[0]))
+        # rows of one array
+        self.assertTrue(all(val.base is values[0].base for val in values))
+        # results and a few full runs, not a full run per level
+        kept = sum(val.nbytes for val in values)
+        self.assertLess(peak, kept + 6*self.run_bytes)
+
+    def test_inactivation_windows(self):
+        out, peak = self.peak("get_inactivation_traces", -5, 50, False,
+                              True)
+        values = list(out.values())
+        # holding and test pulse
+        self.assertEqual(int(np.round(100/self.model.dt)), len(values[0]))
+        kept = sum(val.nbytes for val in values)
+        self.assertLess(peak, kept + 6*self.run_bytes)
+
+
+class TestLegacy(unittest.TestCase):
+    """
+    Legacy sampling reproduces channelunit before the sampling rate
+    could be set, values of the baseline version
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.model = ModelPatch(channel_loc, ["kad"], ["k"],
+                               external_conc={"k": 2.5}, ljp=0, E_rev={},
+                               internal_conc={}, gbar_names={},
+                               gbar_values={}, temp=34, recompile=True,
+                               cvode=False, Rm=20000, v_rest=-65, cm=1,
+                               directory="validation_results",
+                               sim_dt=0.0001)
+        cls.model.set_sampling(LEGACY_SAMPLING_RATE, LEGACY_FILTER_CUTOFF)
+        cls.samples = [0, 10, 100, 1000, 5000, 19999]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.model.close()
+
+    def test_electrode_current(self):
+        out = self.model.get_activation_traces([-30, 10], -90, 1, False,
+                                               True, save_traces=False)
+        self.assertTrue(np.array_equal(
+            out[-30][self.samples],
+            [0.0001336060002375761, 0.00013066974940649861,
+             -0.9794753843804066, 2.204536717062669e-05,
+             9.577848092108177e-05, 0.00018533820973217716]))
+        self.assertTrue(np.array_equal(
+            out[10][self.samples],
+            [0.00019645404648325826, 0.00019244986377274265,
+             -1.335639915953208, 0.00010480406154531527,
+             0.0005138375713884225, 0.0014271009509952413]))
+
+    def test_channel_current(self):
+        out = self.model.get_activation_traces([-30, 10], -90, 1, False,
+                                               False, save_traces=False)
+        self.assertTrue(np.array_equal(
+            out[-30][self.samples],
+            [1.3220209746058232e-06, 1.32202326031676e-06,
+             1.018835301399305e-05, 0.0007058704571479336,
+             0.003050664338291441, 0.005900968295652439]))
+        self.assertTrue(np.array_equal(
+            out[10][self.samples],
+            [1.3220209746058232e-06, 1.3220233765082101e-06,
+             3.652622222827428e-05, 0.00334322525078888,
+             0.01635940693876223, 0.04542821147129558]))
+
+    def test_activation_SS(self):
+        out = self.model.get_activation_SS([-30, 10], -90, 1, 1, None,
+                                           False, True, save_traces=False)
+        self.assertEqual({-30: 0.7333375901551147, 10: 1.0}, out)
+        out = self.model.get_activation_SS([-30, 10], -90, 1, 1, 0.5,
+                                           False, True, save_traces=False)
+        self.assertEqual({-30: 0.16275935138704437, 10: 1.0}, out)
+        out = self.model.get_activation_SS([-30, 10], -90, 1, 1, None,
+                                           False, False, save_traces=False)
+        self.assertEqual({-30: 0.12989655776743586, 10: 1.0}, out)
+
+    def test_inactivation_SS(self):
+        out = self.model.get_inactivation_SS([-90, -50], 10, 1, 1, None,
+                                             False, True, save_traces=False)
+        self.assertEqual({-90: 1.0, -50: 0.7333096693781697}, out)
+        # the peak is the last sample of the run
+        out = self.model.get_inactivation_SS([-90, -50], 10, 1, 1, None,
+                                             False, False, save_traces=False)
+        self.assertEqual({-90: 1.0, -50: 0.34552397405116886}, out)
+        out = self.model.get_inactivation_SS([-90, -50], 10, 1, 1, 1.5,
+                                             False, False, save_traces=False)
+        self.assertEqual({-90: 1.0, -50: 0.3489576178851377}, out)
+
+    def test_inactivation_traces(self):
+        # the whole run, P/N pulses included
+        out = self.model.get_inactivation_traces([-90, -50], 10, 1, False,
+                                                 True, save_traces=False)
+        self.assertEqual(240001, len(out[-50]))
+        self.assertTrue(np.array_equal(
+            out[-50][[20000, 30000, 240000]],
+            [0.0002045326485687429, 0.0003134895459189768,
+             -7.854380446125054e-05]))
+        out = self.model.get_inactivation_traces([-90, -50], 10, 1, False,
+                                                 False, save_traces=False)
+        self.assertEqual(40001, len(out[-50]))
+        self.assertTrue(np.array_equal(
+            out[-50][[0, 20000, 30000, 40000]],
+            [7.96284148900453e-17, 0.00013213290837515778,
+             0.010112259037855112, 0.015696950465842997]))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,147 @@
+import os
+import unittest
+
+from channelunit import data_path
+from channelunit import mechanisms_path
+from channelunit.nmodl import block
+from channelunit.nmodl import mechanism_index
+from channelunit.nmodl import parse_mod
+from channelunit.nmodl import thread_safe
+
+channel_loc = os.path.join(data_path, "ion_channels")
+
+mod = """
+TITLE test channel
+COMMENT
+NEURON { SUFFIX commented }
+ENDCOMMENT
+NEURON {
+    THREADSAFE
+    SUFFIX kt
+    USEION k READ ek WRITE ik
+    USEION ca READ cai, cao VALENCE 2
+    RANGE gkbar, ik,
+          vhalf : half activation
+    GLOBAL tau
+}
+PARAMETER {
+    gkbar = 0.01 (mho/cm2) <0,1e9>
+    vhalf = -40 (mV) tau = 1.5e1 (ms)
+    : gmax = 1
+}
+STATE { n FROM 0 TO 1 l }
+KINETIC kin {
+    ~ n <-> l (1, 1)
+}
+"""
+
+# "NEURON" in the title and in C code
+mod_verbatim = """
+TITLE NEURON { SUFFIX title } model
+VERBATIM
+/* a ? b : c
+NEURON { SUFFIX verbatim }
+*/
+ENDVERBATIM
+NEURON {
+    SUFFIX kv
+    USEION k READ ek WRITE ik
+    RANGE gbar
+}
+PARAMETER { gbar = 0.02 }
+"""
+
+
+class TestParseMod(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mech = parse_mod(mod)
+
+    def test_name(self):
+        self.assertEqual(("kt", "SUFFIX"),
+                         (self.mech["name"], self.mech["kind"]))
+
+    def test_ions(self):
+        self.assertEqual({"k": {"read": ["ek"], "write": ["ik"],
+                                "valence": None},
+                          "ca": {"read": ["cai", "cao"], "write": [],
+                                 "valence": 2}},
+                         self.mech["ions"])
+
+    def test_range(self):
+        self.assertEqual(["gkbar", "ik", "vhalf"], self.mech["range"])
+
+    def test_global(self):
+        self.assertEqual(["tau"], self.mech["global"])
+
+    def test_parameters(self):
+        self.assertEqual({"gkbar": 0.01, "vhalf": -40, "tau": 15},
+                         self.mech["parameters"])
+
+    def test_states(self):
+        self.assertEqual(["n", "l"], self.mech["states"])
+
+    def test_conductances(self):
+        self.assertEqual(["gkbar"], self.mech["conductances"])
+
+    def test_blocks(self):
+        self.assertEqual((True, False, True, False),
+                         (self.mech["kinetic"], self.mech["derivative"],
+                          self.mech["threadsafe"], self.mech["verbatim"]))
+
+    def test_block(self):
+        self.assertIsNone(block(mod, "INITIAL"))
+
+    def test_title_and_verbatim(self):
+        mech = parse_mod(mod_verbatim)
+        self.assertEqual(("kv", "SUFFIX"), (mech["name"], mech["kind"]))
+        self.assertEqual(["k"], list(mech["ions"]))
+        self.assertEqual({"gbar": 0.02}, mech["parameters"])
+        self.assertTrue(mech["verbatim"])
+
+
+class TestMechanismIndex(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.index = mechanism_index(channel_loc)
+
+    def test_all_files(self):
+        self.assertEqual(len(os.listdir(channel_loc)), len(self.index))
+
+    def test_nap(self):
+        nap = self.index["nap"]
+        self.assertEqual(["gnabar"], nap["conductances"])
+        self.assertEqual(["ena"], nap["ions"]["na"]["read"])
+        self.assertEqual("nap.mod", nap["file"])
+
+    def test_permeability(self):
+        self.assertEqual(["pbar"], self.index["CaV21"]["conductances"])
+
+    def test_derivative(self):
+        self.assertTrue(self.index["kad"]["derivative"])
+        self.assertFalse(self.index["kad"]["kinetic"])
+
+    def test_point_process(self):
+        clamp = mechanism_index(mechanisms_path)["SEClampOLS"]
+        self.assertEqual("POINT_PROCESS", clamp["kind"])
+        self.assertEqual(["i"], clamp["electrode_current"])
+        self.assertEqual(1, clamp["parameters"]["rs"])
+
+    def test_thread_safe(self):
+        # checked against pc.nthread(2) in NEURON 9
+        unsafe = ["calGHK", "calGHKCDI", "hd", "kad", "kap", "na3",
+                  "na3dend", "na3notrunk", "nax"]
+        self.assertEqual(unsafe, [name for name, mech in self.index.items()
+                                  if not thread_safe(mech)])
+
+    def test_thread_safe_clamp(self):
+        clamp = mechanism_index(mechanisms_path)["SEClampOLS"]
+        self.assertTrue(thread_safe(clamp))
+
+    def test_cached(self):
+        self.assertIs(self.index["nap"]["ions"],
+                      mechanism_index(channel_loc)["nap"]["ions"])
+
+
+if __name__ == "__main__":
+    unittest.main()
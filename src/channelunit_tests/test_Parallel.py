@@ -0,0 +1,134 @@
+import os
+import unittest
+
+import numpy as np
+
+from channelunit import ModelWholeCellPatch
+from channelunit import ModelWholeCellPatchCaSingleChan
+from channelunit import data_path
+
+channel_loc = os.path.join(data_path, "ion_channels")
+
+
+class TestParallelSweeps(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = ModelWholeCellPatch(channel_loc, ["kad"], ["k"], -65,
+                                        external_conc={"k": 2.5},
+                                        temp=34)
+        # changes made after the model was built reach the workers
+        cls.model.add_channel("kap", "gbar", 0.002)
+        cls.model.set_gbar("kad", 0.005)
+        cls.model.processes = 2
+        # a few levels are enough to use the workers
+        cls.model.min_chunk = 1
+        cls.model_ca = ModelWholeCellPatchCaSingleChan(channel_loc,
+                                                       "calHGHK", "ca",
+                                                       1.5, -65)
+        cls.model_ca.processes = 2
+        cls.model_ca.min_chunk = 1
+        cls.levels = [-30, -10, 10]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.model.close()
+        cls.model_ca.close()
+
+    def serial(self, model, method, *args, **kwargs):
+        model.processes = 1
+        try:
+            return getattr(model, method)(*args, **kwargs)
+        finally:
+            model.processes = 2
+
+    def assert_same(self, serial, parallel):
+        self.assertEqual(list(serial.keys()), list(parallel.keys()))
+        for level in serial:
+            self.assertTrue(np.array_equal(serial[level], parallel[level]))
+
+    def test_activation(self):
+        args = (self.levels, -90, 5)
+        parallel = self.model.get_activation_traces(*args, save_traces=False)
+        serial = self.serial(self.model, "get_activation_traces", *args,
+                             save_traces=False)
+        self.assert_same(serial, parallel)
+
+    def test_inactivation(self):
+        args = (self.levels, 10, 5, False, True)
+        parallel = self.model.get_inactivation_traces(*args,
+                                                      save_traces=False)
+        serial = self.serial(self.model, "get_inactivation_traces", *args,
+                             save_traces=False)
+        self.assert_same(serial, parallel)
+
+    def test_calcium(self):
+        args = ("_activation_sweep", self.levels, -90, 2, False, True, True)
+        time, currents, calcium = self.model_ca._sweep(*args)
+        self.model_ca.processes = 1
+        try:
+            serial = self.model_ca._sweep(*args)
+        finally:
+            self.model_ca.processes = 2
+        self.assertTrue(np.array_equal(serial[0], time))
+        self.assert_same(serial[1], currents)
+        self.assert_same(serial[2], calcium)
+
+    def test_two_pulse(self):
+        # traces of both pulses have different lengths
+        args = ([-90, -30], -90, 20, -5, 5)
+        parallel = self.model.get_two_pulse_traces(*args,
+                                                   electrode_current=False,
+                                                   save_traces=False)
+        serial = self.serial(self.model, "get_two_pulse_traces", *args,
+                             electrode_current=False, save_traces=False)
+        for serial_traces, traces in zip(serial, parallel):
+            self.assert_same(serial_traces, traces)
+
+    def test_out(self):
+        args = (self.levels, -90, 5)
+        out = np.zeros((len(self.levels), int(np.round(5/self.model.dt))))
+        parallel = self.model.get_activation_traces(*args, save_traces=False,
+                                                    out=out)
+        serial = self.serial(self.model, "get_activation_traces", *args,
+                             save_traces=False)
+        self.assert_same(serial, parallel)
+        self.assertTrue(all(val.base is out for val in parallel.values()))
+
+    def test_single_level_serial(self):
+        out = self.model.get_activation_traces([0], -90, 2,
+                                               save_traces=False)
+        self.assertEqual([0], list(out.keys()))
+
+    def test_pool_reused(self):
+        args = (self.levels, -90, 2)
+        self.model.get_activation_traces(*args, save_traces=False)
+        pool = self.model._pool[1]
+        self.model.get_inactivation_traces(self.levels, 10, 2, False, True,
+                                           save_traces=False)
+        self.assertIs(pool, self.model._pool[1])
+
+    def test_few_levels_serial(self):
+        self.model._close_pool()
+        self.model.min_chunk = 4
+        try:
+            self.model.get_activation_traces(self.levels, -90, 2,
+                                             save_traces=False)
+        finally:
+            self.model.min_chunk = 1
+        self.assertIsNone(self.model._pool)
+
+    def test_close(self):
+        model = ModelWholeCellPatch(channel_loc, ["kad"], ["k"], -65,
+                                    external_conc={"k": 2.5}, temp=34)
+        model.processes = 2
+        model.min_chunk = 1
+        model.get_activation_traces(self.levels, -90, 2, save_traces=False)
+        pool = model._pool[1]
+        model.close()
+        self.assertIsNone(model._pool)
+        # shut down
+        self.assertRaises(RuntimeError, pool.submit, abs, -1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,226 @@
+import os
+import unittest
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from neuron import h
+from neuron import rxd
+
+from channelunit import ModelWholeCellPatch
+from channelunit import ModelWholeCellPatchCaSingleChan
+from channelunit import data_path
+
+channel_loc = os.path.join(data_path, "ion_channels")
+
+
+def resident_memory():
+    # resident pages now, unlike ru_maxrss (the peak so far)
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+
+
+def build_close_growth(cycles):
+    """
+    Growth of the resident memory over cycles of building and closing
+    a calcium model, in a process of its own: closing a model with rxd
+    reactions of other models alive loads a newly compiled library
+    of those reactions
+    """
+    def build():
+        return ModelWholeCellPatchCaSingleChan(channel_loc, "calHGHK", "ca",
+                                               1.5, -65)
+    for i in range(5):
+        build().close()
+    rss = resident_memory()
+    for i in range(cycles):
+        build().close()
+    return resident_memory() - rss
+
+
+class TestSession(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model_na = ModelWholeCellPatch(channel_loc, ["nap"], ["na"], -65,
+                                           external_conc={"na": 110},
+                                           gbar_names={"nap": "gnabar"},
+                                           temp=22)
+        cls.model_k = ModelWholeCellPatch(channel_loc, ["kad"], ["k"], -65,
+                                          external_conc={"k": 2.5},
+                                          gbar_values={"kad": 0.005},
+                                          temp=34)
+        cls.model_ca = ModelWholeCellPatchCaSingleChan(channel_loc,
+                                                       "calHGHK", "ca",
+                                                       1.5, -65)
+
+    def test_others_parked(self):
+        with self.model_na.session():
+            self.assertTrue(self.model_k._parked)
+            self.assertFalse(self.model_na._parked)
+            self.assertTrue(self.model_k.patch.has_membrane("kad"))
+
+    def test_held_section(self):
+        patch = self.model_k.patch
+        self.model_na.get_activation_traces([0], -90, 2, save_traces=False)
+        self.assertIs(patch, self.model_k.patch)
+        self.assertTrue(patch.has_membrane("kad"))
+
+    def test_recording_kept(self):
+        voltage = h.Vector()
+        voltage.record(self.model_k.patch(0.5)._ref_v, 0.1)
+        self.model_na.get_activation_traces([0], -90, 2, save_traces=False)
+        # the parked patch is simulated with the other model
+        self.assertGreater(voltage.size(), 0)
+
+    def test_others_restored(self):
+        with self.model_na.session():
+            pass
+        self.assertTrue(self.model_k.patch.has_membrane("kad"))
+        self.assertEqual(self.model_k.get_gbar("kad"), 0.005)
+
+    def test_ca_model_parked(self):
+        with self.model_na.session():
+            self.assertIsNone(self.model_ca.ca)
+            self.assertTrue(self.model_ca.patch.has_membrane("calHGHK"))
+        # till its own session
+        self.assertIsNone(self.model_ca.ca)
+        with self.model_ca.session():
+            self.assertIsNotNone(self.model_ca.ca)
+
+    def nodes(self, model):
+        # rxd sets its nodes up when a simulation is initialized
+        model.get_activation_traces([0], -90, 2, save_traces=False)
+        with model.session():
+            return len(rxd.node._states)
+
+    def test_rxd_parked(self):
+        # rxd integrates no node of a parked calcium model
+        self.assertGreater(self.nodes(self.model_ca), 0)
+        self.assertEqual(0, self.nodes(self.model_k))
+
+    def test_rxd_nodes_flat(self):
+        n_nodes = self.nodes(self.model_ca)
+        with ModelWholeCellPatchCaSingleChan(channel_loc, "calHGHK", "ca",
+                                             1.5, -65) as model:
+            self.assertEqual(n_nodes, self.nodes(model))
+            self.assertEqual(n_nodes, self.nodes(self.model_ca))
+
+    def test_rxd_not_rebuilt(self):
+        others = [ModelWholeCellPatchCaSingleChan(channel_loc, "calHGHK",
+                                                  "ca", 1.5, -65)
+                  for i in range(2)]
+        try:
+            self.model_ca.get_activation_traces([0], -90, 2,
+                                                save_traces=False)
+            species = self.model_ca.ca
+            self.model_ca.get_activation_traces([0], -90, 2,
+                                                save_traces=False)
+            self.assertIs(species, self.model_ca.ca)
+        finally:
+            for model in others:
+                model.close()
+
+    def test_clamp_restored(self):
+        self.model_k.set_vclamp(10, -90, 20, 0, False)
+        with self.model_na.session():
+            pass
+        self.assertEqual(self.model_k.vclamp.dur2, 20)
+        self.assertEqual(self.model_k.vclamp.amp2, 0)
+
+    def test_nested(self):
+        with self.model_na.session():
+            with self.model_na.session():
+                self.assertEqual(h.celsius, 22)
+            self.assertTrue(self.model_k._parked)
+
+    def test_globals(self):
+        h.celsius = 6.3
+        with self.model_k.session():
+            self.assertEqual(h.celsius, 34)
+        self.assertEqual(h.celsius, 6.3)
+
+    def test_cao0(self):
+        h.cao0_ca_ion = 2
+        with self.model_ca.session():
+            self.assertEqual(h.cao0_ca_ion, 1.5)
+        self.assertEqual(h.cao0_ca_ion, 2)
+
+    def test_independent_results(self):
+        out1 = self.model_k.get_activation_traces([-10, 10], -90, 5,
+                                                  save_traces=False)
+        self.model_na.get_activation_traces([-10, 10], -90, 5,
+                                            save_traces=False)
+        # rxd gives the patch 3D points
+        self.model_ca.get_activation_traces([-10, 10], -90, 5,
+                                            save_traces=False)
+        out2 = self.model_k.get_activation_traces([-10, 10], -90, 5,
+                                                  save_traces=False)
+        for level in out1:
+            self.assertTrue(np.array_equal(out1[level], out2[level]))
+
+    def test_independent_ca_results(self):
+        out1 = self.model_ca.get_activation_traces([-10, 10], -90, 5,
+                                                   save_traces=False)
+        self.model_k.get_activation_traces([-10, 10], -90, 5,
+                                           save_traces=False)
+        out2 = self.model_ca.get_activation_traces([-10, 10], -90, 5,
+                                                   save_traces=False)
+        for level in out1:
+            self.assertTrue(np.array_equal(out1[level], out2[level]))
+
+
+class TestClose(unittest.TestCase):
+    def build(self):
+        return ModelWholeCellPatchCaSingleChan(channel_loc, "calHGHK", "ca",
+                                               1.5, -65)
+
+    def test_close_deletes_section(self):
+        n_secs = len(list(h.allsec()))
+        model = self.build()
+        model.close()
+        self.assertEqual(n_secs, len(list(h.allsec())))
+
+    def test_close_twice(self):
+        model = self.build()
+        model.close()
+        model.close()
+        self.assertIsNone(model.patch)
+
+    def test_context_manager(self):
+        n_secs = len(list(h.allsec()))
+        with self.build() as model:
+            out = model.get_activation_traces([0], -90, 2, save_traces=False)
+        self.assertEqual(n_secs, len(list(h.allsec())))
+        self.assertEqual([0], list(out.keys()))
+
+    @staticmethod
+    def live_objects():
+        from neuron.rxd import species
+
+        return (len(list(h.allsec())), h.List("Vector").count(),
+                h.List("SEClampOLS").count(),
+                len([s for s in species._all_species if s() is not None]),
+                len(rxd.node._states))
+
+    def cycle(self):
+        with self.build() as model:
+            model.get_activation_traces([0], -90, 2, save_traces=False)
+
+    def test_objects_flat(self):
+        self.cycle()
+        objects = self.live_objects()
+        for i in range(5):
+            self.cycle()
+        self.assertEqual(objects, self.live_objects())
+
+    @unittest.skipUnless(os.path.exists("/proc/self/statm"), "Linux only")
+    def test_memory_flat(self):
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            growth = pool.submit(build_close_growth, 40).result()
+        # about 10 kB per model left open
+        self.assertLess(growth, 2**17)
+
+
+if __name__ == "__main__":
+    unittest.main()
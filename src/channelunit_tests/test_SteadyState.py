@@ -188,5 +188,21 @@ class TestInactivationSteadyState(unittest.TestCase):
                                   self.test.normalization)
         self.assertEqual(list(out.keys()), self.test.stimulus_list)
 
+    def test_sampling(self):
+        test = InactivationSteadyStateTest(self.inactivation_data,
+                                           {"v_test": -5, "t_test": 10,
+                                            "chord_conductance": False,
+                                            "electrode_current": False,
+                                            "normalization": "to_one",
+                                            "sampling_rate": 10,
+                                            "filter_cutoff": 2},
+                                           1, "InactivationSSTest",
+                                           save_figures=False)
+        dt = self.model.dt
+        out = test.generate_prediction(self.model)
+        self.assertEqual(list(out.keys()), test.stimulus_list)
+        self.assertEqual(dt, self.model.dt)
+        self.assertIsNone(test.filter_order)
+
 if __name__ == "__main__":
     unittest.main()
@@ -149,6 +149,12 @@ class TestPatchWithCa(unittest.TestCase):
                                                           1.5, -65,
                                                           gbar_name="gcal")
 
+    @classmethod
+    def tearDownClass(cls):
+        # rxd objects left behind slow down and grow later rxd models
+        cls.modelcaghk.close()
+        cls.modelca_eca.close()
+
     def test_raises(self):
         self.assertRaises(SystemExit, ModelWholeCellPatchCaSingleChan,
                           channel_loc,